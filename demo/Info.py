@@ -1,22 +1,11 @@
 # import ImageGenerator
 from camel.agents import ChatAgent
-from camel.configs import SiliconFlowConfig
-from camel.models import ModelFactory
-from camel.types import ModelPlatformType
-from config import API_KEY
+from config import API_KEY, BASE_URL
 import json
+import governor
 class InfoReader:
     def __init__(self,input_message=''):
-        self.model = ModelFactory.create(
-            model_platform=ModelPlatformType.SILICONFLOW,
-            model_type="deepseek-ai/DeepSeek-V3",
-            model_config_dict=SiliconFlowConfig(
-                stream=True, 
-                temperature=0.3,
-                # max_tokens=2048
-            ).as_dict(),
-            api_key=API_KEY
-        )
+        self.model = governor.make_model(API_KEY, BASE_URL)
         #self.sys_msg = "你是一个文本总结器"
         # self.InfoReader_agent = ChatAgent(
         # system_message=self.sys_msg,
@@ -25,6 +14,24 @@ class InfoReader:
         # )
         
     def __call__(self,input_message=''):
+        self._prepare(input_message)
+
+        self.json_response=governor.call(self.JsonGenerator_agent.step, self.user_msg+self.additional, stage='mindmap')
+
+        self.Real_Json=json.loads(self.json_response.msg.content)
+
+        #print(list(self.Real_Json))
+
+        return self.Real_Json
+
+    async def acall(self,input_message=''):
+        # __call__ 的异步版本
+        self._prepare(input_message)
+        self.json_response=await governor.acall(self.JsonGenerator_agent.astep, self.user_msg+self.additional, stage='mindmap')
+        self.Real_Json=json.loads(self.json_response.msg.content)
+        return self.Real_Json
+
+    def _prepare(self,input_message):
         self.user_msg = input_message
         # self.response = self.InfoReader_agent.step(self.user_msg)
 
@@ -92,11 +99,3 @@ class InfoReader:
                 将“中心主题，子分支1”等换为相应内容，在最后一层节点中保留尽可能多的字数，如：- **量子力学规则**：颠覆经典计算的底层原理,这样的，你应该做成两个节点！不要输出多余的话,不要输出三引号和json！！！
                 小心不要犯在json文本中缺少引号等低级错误,要检查json格式！！！
         """
-
-        self.json_response=self.JsonGenerator_agent.step(self.user_msg+self.additional)
-
-        self.Real_Json=json.loads(self.json_response.msg.content)
-
-        #print(list(self.Real_Json))
-
-        return self.Real_Json
\ No newline at end of file
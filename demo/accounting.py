@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# 每百万 token 的价格（元）：(输入, 输出)，按 SiliconFlow 上 DeepSeek-V3 的定价，换模型时修改
+PRICE = (2.0, 8.0)
+
+# 当前线程（或协程）中正在进行的 governor.call 的记录
+_entry = contextvars.ContextVar('accounting_entry', default=None)
+
+
+class Entry:
+    """一次 governor.call（ChatAgent.step 或 RolePlaying.step，含重试）的用量和耗时
+
+    latency 为从调用到返回的总时间，包括排队（queue，等待调速器放行）和重试前的等待（wait）；
+    ttft 为最后一次模型请求（即结果所用的那次）从发出到收到第一段文本的时间。
+    RolePlaying.step 每次尝试向模型发出两次请求（user_agent 和 assistant_agent），requests 记实际发出的请求数。
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.started = time.time()
+        self._clock = time.monotonic()
+        self.latency = 0.0
+        self.ttft = None
+        self.queue = 0.0
+        self.wait = 0.0
+        self.retries = 0
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.error = None
+        self._request_started = None
+        # 本次尝试中供应商在流式响应里返回的用量 [(prompt, completion), ...]
+        self._usage = []
+
+    @property
+    def cost(self):
+        return (self.prompt_tokens * PRICE[0] + self.completion_tokens * PRICE[1]) / 1e6
+
+    def attempt(self, queued):
+        # 调速器放行，开始一次尝试；queued 为这次排队的秒数
+        self.queue += queued
+        self._usage = []
+
+    def retry(self, wait):
+        self.retries += 1
+        self.wait += wait
+
+    def request(self):
+        self.requests += 1
+        self.ttft = None
+        self._request_started = time.monotonic()
+
+    def first_token(self):
+        if self.ttft is None and self._request_started is not None:
+            self.ttft = time.monotonic() - self._request_started
+
+    def provider_usage(self, usage):
+        self._usage.append((usage.prompt_tokens or 0, usage.completion_tokens or 0))
+
+    def finish(self, prompt_tokens, completion_tokens):
+        # 优先使用供应商返回的用量，没有时使用 camel 按分词器计算的用量
+        if self._usage:
+            prompt_tokens = sum(p for p, _ in self._usage)
+            completion_tokens = sum(c for _, c in self._usage)
+        self.prompt_tokens, self.completion_tokens = prompt_tokens, completion_tokens
+
+    def as_dict(self):
+        return {
+            'stage': self.stage,
+            'started': round(self.started, 3),
+            'latency': round(self.latency, 3),
+            'ttft': None if self.ttft is None else round(self.ttft, 3),
+            'queue': round(self.queue, 3),
+            'wait': round(self.wait, 3),
+            'retries': self.retries,
+            'requests': self.requests,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'cost': round(self.cost, 6),
+            'error': self.error,
+        }
+
+
+class Ledger:
+    """按任务汇总每次模型调用的记录，任务结束时以 JSON Lines 追加写入文件，每个任务开始时 start()
+
+    同时记录本任务各阶段已用掉的重试次数，供 governor 按 RETRY_POLICY 的预算判断能否再重试。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start()
+
+    def start(self, name=None):
+        # 任务编号为开始时间，加上任务名称（如 read_document）
+        with self._lock:
+            self.started = time.time()
+            self.job = time.strftime('%Y%m%d-%H%M%S') + (f'-{name}' if name else '')
+            self.entries = []
+            self.retries = {}
+
+    def add(self, entry):
+        with self._lock:
+            self.entries.append(entry)
+
+    def take_retry(self, stage, budget):
+        # 该阶段本任务内的重试次数未超过预算时记一次重试并返回 True；进行中的调用也计入
+        with self._lock:
+            if self.retries.get(stage, 0) >= budget:
+                return False
+            self.retries[stage] = self.retries.get(stage, 0) + 1
+            return True
+
+    def totals(self):
+        """按阶段汇总：调用次数、失败次数、重试次数、token 数、费用、总耗时、平均首字时间和成功调用平均发送的 token 数"""
+        with self._lock:
+            entries = list(self.entries)
+        stages = {}
+        for e in entries:
+            t = stages.setdefault(e.stage, {
+                'calls': 0, 'failures': 0, 'retries': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+                'cost': 0.0, 'latency': 0.0, 'queue': 0.0, 'wait': 0.0, 'ttft': [],
+            })
+            t['calls'] += 1
+            t['failures'] += e.error is not None
+            t['retries'] += e.retries
+            t['prompt_tokens'] += e.prompt_tokens
+            t['completion_tokens'] += e.completion_tokens
+            t['cost'] += e.cost
+            t['latency'] += e.latency
+            t['queue'] += e.queue
+            t['wait'] += e.wait
+            if e.ttft is not None:
+                t['ttft'].append(e.ttft)
+        for t in stages.values():
+            ttft = t.pop('ttft')
+            t['ttft'] = sum(ttft) / len(ttft) if ttft else None
+            ok = t['calls'] - t['failures']
+            t['average_prompt'] = t['prompt_tokens'] / ok if ok else 0.0
+        return stages
+
+    def summary(self):
+        # 并发的调用耗时会重叠，各阶段耗时之和可能超过任务的总时间
+        return '；'.join(
+            f"{stage}: 调用 {t['calls']} 次，重试 {t['retries']} 次，失败 {t['failures']} 次，等待 {t['wait']:.1f} 秒，"
+            f"输入 {t['prompt_tokens']} / 输出 {t['completion_tokens']} tokens（平均每次发送约 {t['average_prompt']:.0f}），"
+            f"约 {t['cost']:.4f} 元，耗时 {t['latency']:.1f} 秒"
+            + (f"，平均首字 {t['ttft']:.2f} 秒" if t['ttft'] is not None else '')
+            for stage, t in sorted(self.totals().items(), key=lambda item: -item[1]['latency']))
+
+    def write(self, path):
+        """把本任务的每次调用（type 为 call）和按阶段的汇总（type 为 job）追加到 path"""
+        with self._lock:
+            entries = list(self.entries)
+        if not entries:
+            return
+        stages = {stage: {k: round(v, 6) if isinstance(v, float) else v for k, v in t.items()}
+                  for stage, t in self.totals().items()}
+        with open(path, 'a', encoding='utf-8') as f:
+            for e in entries:
+                f.write(json.dumps({'type': 'call', 'job': self.job, **e.as_dict()}, ensure_ascii=False) + '\n')
+            f.write(json.dumps({
+                'type': 'job',
+                'job': self.job,
+                'started': round(self.started, 3),
+                'elapsed': round(time.time() - self.started, 3),
+                'cost': round(sum(e.cost for e in entries), 6),
+                'stages': stages,
+            }, ensure_ascii=False) + '\n')
+
+
+LEDGER = Ledger()
+
+
+@contextmanager
+def track(stage):
+    """记录一次 governor.call：with 块内发出的模型请求都计入返回的 Entry，结束时加入 LEDGER"""
+    entry = Entry(stage)
+    token = _entry.set(entry)
+    try:
+        yield entry
+    except BaseException as e:
+        entry.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        _entry.reset(token)
+        entry.latency = time.monotonic() - entry._clock
+        LEDGER.add(entry)
+
+
+def request():
+    # watch 包装的模型每次发出请求时调用
+    entry = _entry.get()
+    if entry is not None:
+        entry.request()
+
+
+def _observe_chunk(entry, chunk):
+    if any(choice.delta.content for choice in chunk.choices):
+        entry.first_token()
+    if getattr(chunk, 'usage', None):
+        entry.provider_usage(chunk.usage)
+
+
+def observer():
+    """返回记录流式响应每一块的首字时间和供应商用量的函数 observe(chunk)，不在 track 中时返回 None"""
+    entry = _entry.get()
+    if entry is None:
+        return None
+    return lambda chunk: _observe_chunk(entry, chunk)
+
+
+def observe(response):
+    """记录非流式响应的首字时间和供应商返回的用量"""
+    entry = _entry.get()
+    if entry is None:
+        return
+    entry.first_token()
+    if getattr(response, 'usage', None):
+        entry.provider_usage(response.usage)
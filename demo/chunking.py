@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import re
+import math
+
+# 按 DeepSeek 官方的估算口径：1 个中文字符约 0.6 token，1 个英文字符约 0.3 token
+_CJK = re.compile(r'[　-〿㐀-䶿一-鿿豈-﫿＀-￯]')
+
+
+def estimate_tokens(text):
+    """粗略估计文本的 token 数，不依赖分词器"""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return math.ceil(cjk * 0.6 + (len(text) - cjk) * 0.3)
+
+
+def _split_long_line(line, budget):
+    # 单行超过预算时按字符硬切；每个字符至多 0.6 token，按此切分保证不超预算
+    size = max(1, int(budget / 0.6))
+    return [line[i:i + size] for i in range(0, len(line), size)]
+
+
+def split_chunks(text, budget=6000, overlap=300):
+    """按行把文本切成不超过 budget token 的窗口，相邻窗口重叠约 overlap token"""
+    lines = []
+    for line in text.split('\n'):
+        if estimate_tokens(line) > budget:
+            lines.extend(_split_long_line(line, budget))
+        else:
+            lines.append(line)
+
+    chunks = []
+    current, size = [], 0
+    for line in lines:
+        n = estimate_tokens(line) + 1
+        if current and size + n > budget:
+            chunks.append('\n'.join(current))
+            # 保留末尾若干行作为下一个窗口的开头
+            tail, tail_size = [], 0
+            for prev in reversed(current):
+                m = estimate_tokens(prev) + 1
+                if tail_size + m > overlap or tail_size + m + n > budget:
+                    break
+                tail.insert(0, prev)
+                tail_size += m
+            current, size = tail, tail_size
+        current.append(line)
+        size += n
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+
+def group_by_budget(items, budget, cost=estimate_tokens):
+    """把有序的条目打包成若干组，每组总量不超过 budget（单个超限的条目独占一组）"""
+    groups = []
+    current, size = [], 0
+    for item in items:
+        n = cost(item)
+        if current and size + n > budget:
+            groups.append(current)
+            current, size = [], 0
+        current.append(item)
+        size += n
+    if current:
+        groups.append(current)
+    return groups
@@ -1,2 +1,27 @@
 API_KEY = ''
-# 例如 APIKEY = '114514'
\ No newline at end of file
+# 例如 APIKEY = '114514'
+
+# 模型服务地址（OpenAI 兼容接口）；离线测试时先运行 python fake_server.py，再改为 'http://127.0.0.1:8765/v1'
+BASE_URL = 'https://api.siliconflow.cn/v1'
+
+# 记忆文件，以 .db 结尾时使用 SQLite 存储
+MEMORY_PATH = 'memory.json'
+# 记忆命名空间，不同用户或会话各用一份记忆；留空时共用 MEMORY_PATH
+MEMORY_NAMESPACE = ''
+# 记忆淘汰策略，None 表示不限制：最多保留的文档篇数、正文总字符数、多少天未被使用即删除
+MEMORY_MAX_DOCUMENTS = None
+MEMORY_MAX_CHARS = None
+MEMORY_TTL_DAYS = None
+
+# 模型调用限额，按账号等级修改：每分钟请求数、每分钟 token 数、同时进行的请求数上限
+RATE_LIMIT_RPM = 1000
+RATE_LIMIT_TPM = 50000
+MAX_CONCURRENCY = 8
+
+# 生成提纲的 Agent 的对话记忆：'fresh' 每次请求新对话，'window' 保留最近 LEARNING_HISTORY_TOKENS 以内的对话，'full' 保留全部
+LEARNING_HISTORY = 'fresh'
+LEARNING_HISTORY_TOKENS = 4000
+
+# 每次模型调用的 token 数、耗时和费用按任务追加写入的 JSON Lines 文件，留空则不写；价格为每百万 token 的元数 (输入, 输出)
+USAGE_LOG = 'usage.jsonl'
+MODEL_PRICE = (2.0, 8.0)
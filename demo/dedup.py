@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import re
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+from chunking import estimate_tokens
+
+# MinHash 使用的哈希族 h(x) = (a * x + b) mod p，x 为 32 位整数，乘积不会溢出 uint64
+_PRIME = np.uint64((1 << 31) - 1)
+# 形如页码的行；只有在大多数幻灯片的同一位置出现时才当作页码，否则表格中的年份、分数等也会被删掉
+_PAGE_NUMBER = re.compile(r'^(?:第\s*)?\d{1,4}(?:\s*[/／]\s*\d{1,4})?(?:\s*页)?$|^page\s*\d+$', re.IGNORECASE)
+
+
+def normalize(text):
+    return ' '.join(text.split())
+
+
+def shingles(text, k=5):
+    """字符 k-gram 集合，对中文不需要分词"""
+    text = normalize(text)
+    if len(text) <= k:
+        return {text} if text else set()
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+class MinHasher:
+    def __init__(self, num_perm=64, seed=1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.a = rng.integers(1, int(_PRIME), size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, int(_PRIME), size=num_perm, dtype=np.uint64)
+
+    def signature(self, shingle_set):
+        if not shingle_set:
+            return np.full(self.num_perm, int(_PRIME), dtype=np.uint64)
+        x = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingle_set),
+                        dtype=np.uint64, count=len(shingle_set)) % _PRIME
+        return ((np.outer(self.a, x) + self.b[:, None]) % _PRIME).min(axis=1)
+
+
+def dump_signature(sig):
+    # 签名中的值都小于 2^31，按 uint32 保存为十六进制字符串（64 个值 512 个字符），可以放进 JSON 元数据
+    return np.asarray(sig, dtype=np.uint32).tobytes().hex()
+
+
+def load_signature(text):
+    return np.frombuffer(bytes.fromhex(text), dtype=np.uint32).astype(np.uint64)
+
+
+def similarity(sig_a, sig_b):
+    # 两个签名估计的 Jaccard 相似度
+    return float(np.mean(np.asarray(sig_a) == np.asarray(sig_b)))
+
+
+class LSHIndex:
+    """MinHash 签名的分段局部敏感哈希索引，查询只比较同桶中的候选"""
+
+    def __init__(self, bands=16, rows=4):
+        self.bands = bands
+        self.rows = rows
+        self.buckets = defaultdict(set)
+
+    def _keys(self, sig):
+        sig = np.asarray(sig, dtype=np.uint64)
+        for i in range(self.bands):
+            yield i, sig[i * self.rows:(i + 1) * self.rows].tobytes()
+
+    def add(self, key, sig):
+        for band in self._keys(sig):
+            self.buckets[band].add(key)
+
+    def remove(self, key, sig):
+        for band in self._keys(sig):
+            self.buckets[band].discard(key)
+
+    def query(self, sig):
+        found = set()
+        for band in self._keys(sig):
+            found |= self.buckets.get(band, set())
+        return found
+
+
+def strip_boilerplate(blocks, min_slides=4, line_ratio=0.5, dup_threshold=0.9):
+    """去除幻灯片中的重复内容：页脚、课程名、页码等在大量幻灯片上重复出现的行，以及近似重复的幻灯片
+
+    只处理 pptx 的块（slide 不为 None），标题块不会被当作页脚删除。
+    返回 (清洗后的块列表, 统计信息)。
+    """
+    blocks = list(blocks)
+    before = estimate_tokens('\n'.join(b.text for b in blocks))
+    slides = defaultdict(list)
+    for b in blocks:
+        if b.slide is not None:
+            slides[b.slide].append(b)
+
+    stats = {'tokens_before': before, 'tokens_after': before, 'tokens_saved': 0,
+             'lines_removed': 0, 'slides_removed': 0}
+    if len(slides) < min_slides:
+        return blocks, stats
+
+    # 1. 统计每一行出现在多少张幻灯片上
+    seen = defaultdict(int)
+    for slide_blocks in slides.values():
+        for line in {normalize(b.text) for b in slide_blocks if not b.heading}:
+            if line:
+                seen[line] += 1
+    limit = max(2, line_ratio * len(slides))
+    repeated = {line for line, n in seen.items() if n >= limit}
+
+    # 手工输入的页码：在大量幻灯片的同一位置（从开头或末尾数）出现、且数值随幻灯片序号递增的行才删除
+    # （页码占位符中的页码在解析时已跳过）
+    positions = defaultdict(list)
+    for s, slide_blocks in slides.items():
+        for k, b in enumerate(slide_blocks):
+            line = normalize(b.text)
+            if not b.heading and _PAGE_NUMBER.match(line):
+                offset = int(re.search(r'\d+', line).group()) - s
+                positions['start', k, offset].append((s, b.paragraph))
+                positions['end', len(slide_blocks) - 1 - k, offset].append((s, b.paragraph))
+    page_numbers = set()
+    for found in positions.values():
+        if len({s for s, _ in found}) >= limit:
+            page_numbers.update(found)
+
+    def is_boilerplate(b):
+        if b.heading:
+            return False
+        return normalize(b.text) in repeated or (b.slide, b.paragraph) in page_numbers
+
+    # 2. 近似重复的幻灯片只保留第一张
+    hasher = MinHasher()
+    index = LSHIndex()
+    signatures = {}
+    dropped_slides = set()
+    for s in sorted(slides):
+        text = '\n'.join(b.text for b in slides[s] if not is_boilerplate(b))
+        sh = shingles(text)
+        if not sh:
+            continue
+        sig = hasher.signature(sh)
+        if any(similarity(sig, signatures[c]) >= dup_threshold for c in index.query(sig)):
+            dropped_slides.add(s)
+            continue
+        signatures[s] = sig
+        index.add(s, sig)
+
+    cleaned = []
+    for b in blocks:
+        if b.slide is None:
+            cleaned.append(b)
+        elif b.slide in dropped_slides:
+            continue
+        elif is_boilerplate(b):
+            stats['lines_removed'] += 1
+        else:
+            cleaned.append(b)
+    after = estimate_tokens('\n'.join(b.text for b in cleaned))
+    stats.update(tokens_after=after, tokens_saved=before - after, slides_removed=len(dropped_slides))
+    return cleaned, stats
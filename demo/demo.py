@@ -8,62 +8,76 @@ from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
 from PySide6.QtCore import Qt, QThread, Signal, QTimer
 from PySide6.QtGui import QTextCursor
 
-from camel.configs import SiliconFlowConfig
-from camel.models import ModelFactory
-from camel.types import ModelPlatformType
 
 import time
+import html
+import asyncio
 
 import learning_assistant
-from subagent import create
+from subagent import create, acreate
 from Info import InfoReader
 from Image import InteractiveMindMap
+from doc_cache import DocumentCache
 
-from config import API_KEY
+from config import API_KEY, BASE_URL, MEMORY_PATH, MEMORY_NAMESPACE, MEMORY_MAX_DOCUMENTS, MEMORY_MAX_CHARS, MEMORY_TTL_DAYS
+from config import RATE_LIMIT_RPM, RATE_LIMIT_TPM, MAX_CONCURRENCY, LEARNING_HISTORY, LEARNING_HISTORY_TOKENS
+from config import USAGE_LOG, MODEL_PRICE
+import governor
+import streaming
+import accounting
+
+# 所有模型请求共用一个调速器
+governor.configure(rpm=RATE_LIMIT_RPM, tpm=RATE_LIMIT_TPM, max_concurrency=MAX_CONCURRENCY)
+accounting.PRICE = MODEL_PRICE
 
 # 初始化dot.exe所在目录
 os.environ["PATH"] += os.pathsep + r'D:\study\2025spring\ai basic\bighw\test\Graphviz-13.0.1-win64\bin'
 
-# 初始化硅基流动模型
-model = ModelFactory.create(
-    model_platform=ModelPlatformType.SILICONFLOW,
-    model_type="deepseek-ai/DeepSeek-V3",  # 可选模型：DeepSeek-V3/R1 等
-    model_config_dict=SiliconFlowConfig(
-        stream=True,      # !!!!!!!!!!!!!!!!!!!!!!!!!
-        temperature=0.3,  # 控制生成随机性 (0~1)
-        # max_tokens=2048   # 最大输出长度
-    ).as_dict(),
-    api_key=API_KEY  # 替换为你的 API 密钥
-)
-
 # --------------------- 模型层：Agent封装 ---------------------
 class CamelAIAgent:
     def __init__(self):
-        self.loader = learning_assistant.DocumentLoader()
-        self.mem = learning_assistant.MemoryStore()
-        self.agent = learning_assistant.LearningAgent(api_key=API_KEY)
+        self.loader = learning_assistant.DocumentLoader(cache=DocumentCache())
+        self.mem = learning_assistant.open_memory(
+            MEMORY_PATH, MEMORY_NAMESPACE, max_documents=MEMORY_MAX_DOCUMENTS, max_chars=MEMORY_MAX_CHARS,
+            ttl=MEMORY_TTL_DAYS * 86400 if MEMORY_TTL_DAYS is not None else None)
+        self.agent = learning_assistant.LearningAgent(api_key=API_KEY, base_url=BASE_URL, history=LEARNING_HISTORY,
+                                                      history_tokens=LEARNING_HISTORY_TOKENS)
         self.Reader=InfoReader()
+        # 提纲生成方式，见 LearningAgent.outline
+        self.outline_mode = 'auto'
+        # 每次请求附带的相关记忆上下文的 token 上限
+        self.context_tokens = 2000
     
     def process_document(self, file_path):
         """解析文档并返回大纲"""
-        # 逐个加载文档，记忆知识领域
-        for path in file_path:
-            print(f"加载文件: {path}")
-            text = self.loader.load(path)
-            self.mem.add_document(text)
-            # 提取并记忆该文档的知识领域
-            domains = self.agent.extract_domains(text, self.mem.get_context())
-            for d in domains:
-                self.mem.add_domain(d)
+        # 并行加载文档，记忆知识领域
+        docs = learning_assistant.ingest(file_path, self.loader, self.mem, self.agent,
+                                         context_tokens=self.context_tokens, outline_mode=self.outline_mode)
 
-        # 使用最后一个文档生成提纲
-        content = self.mem.data['documents'][-1]
-        outline = self.agent.generate_outline(content, self.mem.get_context())
-        return outline
+        # 使用最后一个文档生成提纲，文档修改后再次导入时只重新生成变化的部分
+        return learning_assistant.make_outline(docs[-1], self.mem, self.agent, self.outline_mode,
+                                               self.context_tokens)
+    
+    async def aprocess_document(self, file_path):
+        """process_document 的异步版本：导入时的领域提取和提纲的各次请求都在事件循环中并发"""
+        docs = await learning_assistant.aingest(file_path, self.loader, self.mem, self.agent,
+                                                context_tokens=self.context_tokens, outline_mode=self.outline_mode)
+        return await learning_assistant.amake_outline(docs[-1], self.mem, self.agent, self.outline_mode,
+                                                      self.context_tokens)
     
     def generate(self, outline):
        return create(outline)
 
+    async def agenerate(self, outline):
+        # 文档各部分并发生成
+        return await acreate(outline)
+
+    def forget(self):
+        """清除记忆和已生成的文档"""
+        self.mem.clear()
+        with open("generated_document.md", "w", encoding="utf-8") as f:
+            f.write('')
+
 
 # --------------------- 控制层：多线程任务 ---------------------
 class ProcessTaskThread(QThread):
@@ -71,6 +85,8 @@ class ProcessTaskThread(QThread):
     task_completed = Signal(dict)
     progress_updated = Signal(int)
     error_occurred = Signal(str)
+    # 模型的流式输出：事件（start/delta/end，见 streaming.listen）、阶段、文本
+    stream_event = Signal(str, str, str)
     
     def __init__(self, agent, task_type, file_path=None, user_input=None):
         super().__init__()
@@ -81,53 +97,65 @@ class ProcessTaskThread(QThread):
         self.is_running = True
     
     def run(self):
-        try:
-            if self.task_type == "forget":
-                self.progress_updated.emit(100)
-                self.task_completed.emit({
-                    "type": "forget",
-                    "data": ''
-                })
-                return
+        # 每个任务单独统计每次模型调用的 token 数、耗时、重试和费用，重试预算也按任务计算
+        accounting.LEDGER.start(self.task_type)
+        # 模型的流式输出经信号实时转给界面
+        with streaming.listen(self.stream_event.emit):
+            try:
+                if self.task_type == "forget":
+                    # 在后台线程中通过记忆对象清除，和其他读写一样经过文件锁
+                    self.agent.forget()
+                    self.progress_updated.emit(100)
+                    self.task_completed.emit({
+                        "type": "forget",
+                        "data": ''
+                    })
+                    return
             
-            if not self.file_path:
-                self.error_occurred.emit("请先选择文档")
-                return
-            self.progress_updated.emit(0)
+                if not self.file_path:
+                    self.error_occurred.emit("请先选择文档")
+                    return
+                self.progress_updated.emit(0)
+                # 一个任务中的模型请求都在同一个事件循环中进行
+                asyncio.run(self.arun_task())
                 
-            # 1. 解析文档
-            outline = self.agent.process_document([self.file_path])
-            self.progress_updated.emit(20)
-            
-            if self.task_type == "read_document":
-                doc_result = self.agent.generate(outline)
-                self.progress_updated.emit(60)
-                # 模拟进度
-                for i in range(60, 101, 10):
-                    time.sleep(0.1)
-                    self.progress_updated.emit(i)
-                self.task_completed.emit({
-                    "type": "document",
-                    "data": doc_result
-                })
+            except Exception as e:
+                # 重试次数用完才会到这里；已生成的提纲片段和文档章节都已保留，再次执行时从失败处继续
+                self.error_occurred.emit(f"处理失败：{str(e)}（已完成的部分已保留，可重新执行）")
+            finally:
+                stats = accounting.LEDGER.summary()
+                if stats:
+                    print(f"模型调用统计: {stats}")
+                if USAGE_LOG:
+                    accounting.LEDGER.write(USAGE_LOG)
+    
+    async def arun_task(self):
+        # 1. 解析文档
+        outline = await self.agent.aprocess_document([self.file_path])
+        self.progress_updated.emit(20)
+    
+        if self.task_type == "read_document":
+            doc_result = await self.agent.agenerate(outline)
+            self.progress_updated.emit(100)
+            self.task_completed.emit({
+                "type": "document",
+                "data": doc_result
+            })
 
-            elif self.task_type == "mind_map":
-                self.progress_updated.emit(60)
-                # 2. 生成思维导图
-                mindmap_data = self.agent.Reader(input_message=outline)
-                self.progress_updated.emit(100)
-                
-                # if error:
-                #     self.error_occurred.emit(error)
-                #     return
-                
-                self.task_completed.emit({
-                    "type": "mind_map",
-                    "data": mindmap_data
-                })
-                
-        except Exception as e:
-            self.error_occurred.emit(f"处理失败：{str(e)}")
+        elif self.task_type == "mind_map":
+            self.progress_updated.emit(60)
+            # 2. 生成思维导图
+            mindmap_data = await self.agent.Reader.acall(input_message=outline)
+            self.progress_updated.emit(100)
+        
+            # if error:
+            #     self.error_occurred.emit(error)
+            #     return
+        
+            self.task_completed.emit({
+                "type": "mind_map",
+                "data": mindmap_data
+            })
     
     def stop(self):
         self.is_running = False
@@ -143,13 +171,15 @@ class GUI(QMainWindow):
         
         self.agent = CamelAIAgent()
         self.current_task_thread = None
-        # 用于文本动画的定时器
-        self.typing_timer = QTimer(self)
-        self.typing_timer.timeout.connect(self.update_typing_text)
-        self.typing_data = {
-            'full_text': '',      # 完整文本
-            'current_text': '',   # 当前已显示的文本
-            'index': 0,           # 当前字符索引
+        # 流式输出的文本先累积，最多每 100ms 刷新一次结果区，避免每个片段都重新渲染全文
+        self.render_timer = QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.timeout.connect(self.render_stream)
+        self.stream_data = {
+            'view': None,         # 当前显示的内容：提纲、文档或思维导图
+            'committed': '',      # 已完成的请求输出的文本
+            'current': '',        # 正在进行的请求已收到的文本
+            'saved': None,        # 思维导图的流式输出占用文本区之前，文本区原来的内容
         }
         self.setup_ui()
     
@@ -270,6 +300,8 @@ class GUI(QMainWindow):
         self.current_task_thread.task_completed.connect(self.handle_task_result)
         self.current_task_thread.progress_updated.connect(self.update_progress)
         self.current_task_thread.error_occurred.connect(self.show_error)
+        self.current_task_thread.stream_event.connect(self.handle_stream)
+        self.stream_data.update(view=None, committed='', current='', saved=None)
         self.current_task_thread.start()
         
         self.status_bar.showMessage(f"正在执行: {task_type}")
@@ -289,14 +321,11 @@ class GUI(QMainWindow):
             self.text_result.setHtml(html_content)
             self.result_tab.setCurrentIndex(0)
             self.add_chat_message("系统", f"已生成文档，共{len(content.split())}个单词")
-            # 配置打字机效果参数
-            self.typing_data['full_text'] = content
-            self.typing_data['current_text'] = ''
-            self.typing_data['index'] = 0
-            # 启动文本动画
-            self.typing_timer.start(50)  # 每50ms显示一个字符
+            # 生成过程中已流式显示，这里换成整理后的完整文档
+            self.render_timer.stop()
         
         elif result["type"] == "mind_map":
+            self.restore_text_result()
             self.result_tab.removeTab(1)
             self.mind_map_display = InteractiveMindMap(result["data"])
             self.mind_map_display.setStyleSheet("border: 1px dashed #ccc; padding: 20px;")
@@ -305,10 +334,6 @@ class GUI(QMainWindow):
             self.add_chat_message("系统", "思维导图生成完成")
         
         elif result["type"] == "forget":
-            with open("generated_document.md", "w", encoding="utf-8") as f:
-                f.write('')
-            with open("memory.json", 'w', encoding='utf-8') as g:
-                g.write('{"domains": [], "documents": []}')
             html_content = markdown.markdown('')
             self.text_result.setHtml(html_content)
             self.result_tab.removeTab(1)
@@ -327,22 +352,51 @@ class GUI(QMainWindow):
         self.mind_map_btn.setEnabled(True)
         self.forget_btn.setEnabled(True)
                 
-    def update_typing_text(self):
-        # 逐字模式
-        if self.typing_data['index'] < len(self.typing_data['full_text']):
-            self.typing_data['current_text'] += self.typing_data['full_text'][self.typing_data['index']]
-            self.typing_data['index'] += 1
-            
-            # 将当前文本转换为HTML并显示
-            html_content = markdown.markdown(self.typing_data['current_text'])
-            self.text_result.setHtml(html_content)
-            
-            # 滚动到底部
-            self.text_result.moveCursor(QTextCursor.End)
+    # 各阶段的流式输出在结果区中的显示位置；未列出的阶段（如知识领域提取、大纲分解）不显示
+    STREAM_VIEWS = {'outline': 'outline', 'section': 'document', 'mindmap': 'mindmap'}
+
+    def handle_stream(self, event, stage, text):
+        view = self.STREAM_VIEWS.get(stage)
+        if view is None:
+            return
+        data = self.stream_data
+        if view != data['view']:
+            # 进入新的阶段，如提纲生成完毕开始生成文档
+            if view == 'mindmap' and data['saved'] is None:
+                data['saved'] = self.text_result.toHtml()
+            data.update(view=view, committed='', current='')
+            self.result_tab.setCurrentIndex(0)
+        if event == 'start':
+            data['current'] = ''
+        elif event == 'delta':
+            data['current'] += text
         else:
-            self.typing_timer.stop()  # 完成后停止计时器        
+            data['committed'] += data['current'] + '\n\n'
+            data['current'] = ''
+        if not self.render_timer.isActive():
+            self.render_timer.start(100)
+
+    def render_stream(self):
+        data = self.stream_data
+        text = data['committed'] + data['current']
+        if data['view'] == 'mindmap':
+            # 思维导图的 JSON 生成完毕后才能绘制，生成过程中按原文显示
+            self.text_result.setHtml(f"<pre>{html.escape(text)}</pre>")
+        else:
+            self.text_result.setHtml(markdown.markdown(text))
+        # 滚动到底部
+        self.text_result.moveCursor(QTextCursor.End)
+
+    def restore_text_result(self):
+        # 思维导图的 JSON 只在生成过程中临时显示在文本区，结束后恢复文本区原来的内容（如已生成的文档）
+        data = self.stream_data
+        if data['saved'] is not None:
+            self.render_timer.stop()
+            self.text_result.setHtml(data['saved'])
+            data.update(view=None, committed='', current='', saved=None)
     
     def show_error(self, error_msg):
+        self.restore_text_result()
         self.progress_bar.setValue(0)
         self.read_btn.setEnabled(True)
         self.mind_map_btn.setEnabled(True)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import zlib
+import hashlib
+import tempfile
+
+
+class DocumentCache:
+    """按文件内容寻址的解析结果缓存
+
+    键为文件字节的 SHA-256 加上解析器版本，值为压缩后的块列表；
+    缓存目录总大小超过 max_bytes 时按最近使用时间淘汰。
+    """
+
+    def __init__(self, cache_dir='.doc_cache', max_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, path, version):
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        h.update(f'|{version}'.encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json.z')
+
+    def get(self, key):
+        # 命中时返回块元组列表，未命中返回 None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # 更新访问时间，供 LRU 淘汰使用
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        try:
+            return [tuple(b) for b in json.loads(zlib.decompress(data).decode('utf-8'))]
+        except (zlib.error, ValueError):
+            # 缓存文件损坏，当作未命中
+            return None
+
+    def put(self, key, blocks):
+        data = zlib.compress(
+            json.dumps([list(b) for b in blocks], ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        )
+        # 先写临时文件再原子替换，避免并发读取到半个文件
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.json.z'):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import re
+import zlib
+
+import numpy as np
+
+# 模型回复中常见的编号、项目符号、markdown 加粗和首尾标点
+_LEADING = re.compile(r'^(?:[-*•·#>\s]+|\d+[.、)）]\s*|[（(]\d+[)）]\s*)+')
+_STRIP = ' \t\r\n。．.，,、；;：:！!？?“”"‘’\'`*_【】[]（）()《》<>'
+
+
+def normalize_domain(text, max_len=30):
+    """清理单个知识领域关键词，无效时返回空串"""
+    text = _LEADING.sub('', text.strip())
+    text = text.replace('**', '').strip(_STRIP)
+    text = ' '.join(text.split())
+    # 过长的多半是模型输出的整句说明，而不是关键词
+    if not text or len(text) > max_len:
+        return ''
+    return text
+
+
+def split_domains(reply):
+    # 模型可能用逗号、顿号、分号或换行分隔
+    return [d for d in (normalize_domain(p) for p in re.split(r'[,，、;；\n]', reply)) if d]
+
+
+# 归并时忽略的标点、空白和通用后缀，如“量子计算基础”“量子计算。”都视为“量子计算”
+_PUNCT = re.compile(r'[\W_]+')
+_GENERIC_SUFFIX = re.compile(r'(?:基础知识|基础|概述|简介|入门|概论|导论|初步|知识)$')
+# 否定或限定的字词：名称只差这些时是不同（甚至相反）的概念，如“定积分/不定积分”“一元/多元函数微分”
+_QUALIFIER = re.compile(r'不|非|无|未|反|逆|负|正|多|单|一|二|三|双|半|偏|全|上|下|高|低|前|后|内|外|有|线性|离散|连续')
+
+
+def domain_key(name):
+    """比较知识领域是否相同时使用的键：小写，去掉标点、空白和通用后缀"""
+    key = _PUNCT.sub('', name.lower())
+    return _GENERIC_SUFFIX.sub('', key) or key
+
+
+def _compatible(a, b):
+    # 两个键去掉共同的开头和结尾后，剩下的差异不能在开头，也不能含否定或限定的字词
+    i = 0
+    while i < min(len(a), len(b)) and a[i] == b[i]:
+        i += 1
+    j = 0
+    while j < min(len(a), len(b)) - i and a[-1 - j] == b[-1 - j]:
+        j += 1
+    if i == 0:
+        return False
+    return not (_QUALIFIER.search(a[i:len(a) - j]) or _QUALIFIER.search(b[i:len(b) - j]))
+
+
+class DomainMerger:
+    """把近似的知识领域归并到同一个规范名称
+
+    只差标点、空白、大小写或通用后缀的名称（domain_key 相同）直接归并；其余按字符 n-gram 向量的
+    余弦相似度比较，超过 threshold 且差异不涉及否定或限定字词的才归并。
+    所有规范名称的向量保存在一个矩阵里，一批新词与整个词表的相似度用一次矩阵乘法算出。
+    """
+
+    def __init__(self, canonical=(), threshold=0.9, dim=1024):
+        self.threshold = threshold
+        self.dim = dim
+        self.names = []
+        self._known = set()
+        self._keys = {}
+        self.matrix = np.zeros((0, dim), dtype=np.float32)
+        self.extend(canonical)
+
+    def _vectors(self, names):
+        # 一元和二元字符组哈希到 dim 维，再做 L2 归一化
+        out = np.zeros((len(names), self.dim), dtype=np.float32)
+        for row, name in enumerate(names):
+            text = name.lower().replace(' ', '')
+            grams = list(text) + [text[i:i + 2] for i in range(len(text) - 1)]
+            for g in grams:
+                out[row, zlib.crc32(g.encode('utf-8')) % self.dim] += 1.0
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return out / norms
+
+    def __contains__(self, name):
+        return name in self._known
+
+    def _add_names(self, names):
+        self.names.extend(names)
+        self._known.update(names)
+        for name in names:
+            self._keys.setdefault(domain_key(name), name)
+
+    def extend(self, names):
+        names = list(names)
+        if names:
+            self._add_names(names)
+            self.matrix = np.vstack([self.matrix, self._vectors(names)])
+
+    def merge(self, names):
+        """返回 [(名称, 规范名称或 None, 是否只差标点或通用后缀)]；None 表示是新的规范名称，已加入词表
+
+        第三项为 False 的归并只凭字面相似度得出，调用方不应把它当作永久的别名保存。
+        """
+        names = list(dict.fromkeys(names))
+        if not names:
+            return []
+        vectors = self._vectors(names)
+        # 与已有词表的相似度一次算完
+        sims = vectors @ self.matrix.T if len(self.names) else np.zeros((len(names), 0), dtype=np.float32)
+        result = []
+        new_rows = []
+        new_keys = {}
+        for i, name in enumerate(names):
+            key = domain_key(name)
+            same = self._keys.get(key) or new_keys.get(key)
+            if same is not None:
+                result.append((name, same, True))
+                continue
+            best, score = None, 0.0
+            if sims.shape[1]:
+                j = int(np.argmax(sims[i]))
+                best, score = self.names[j], float(sims[i, j])
+            # 同一批中先出现的新词也参与比较
+            for k in new_rows:
+                s = float(vectors[i] @ vectors[k])
+                if s > score:
+                    best, score = names[k], s
+            if score >= self.threshold and _compatible(key, domain_key(best)):
+                result.append((name, best, False))
+            else:
+                result.append((name, None, False))
+                new_rows.append(i)
+                new_keys[key] = name
+        if new_rows:
+            self._add_names([names[k] for k in new_rows])
+            self.matrix = np.vstack([self.matrix, vectors[new_rows]])
+        return result
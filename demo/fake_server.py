@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""本地模拟的 SiliconFlow 服务，兼容 OpenAI 的 /v1/chat/completions 接口（含流式响应）
+
+按请求的系统提示和提示词判断是哪一步（知识领域、提纲、大纲分解、章节内容、思维导图），
+返回与 learning_assistant.py、subagent.py、Info.py 的提示词格式一致的固定回复，
+用于在没有网络和 API 密钥时测试整个流程的性能。可以模拟首字延迟、生成速度、429 限流和格式错误的 JSON。
+
+    python fake_server.py --latency 0.5 --tokens_per_sec 40 --rate_429 0.1 --malformed 0.05
+
+然后把 config.py 中的 BASE_URL 改为 http://127.0.0.1:8765/v1（learning_assistant.py 为 --base_url），API_KEY 任意。
+"""
+import re
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from chunking import estimate_tokens
+
+_HEADING = re.compile(r'^\s*(?:#{1,6}\s+|\d+(?:\.\d+)*[.、)]\s+|[-*]\s+\*\*)(.+?)(?:\*\*.*)?\s*$')
+_SECTION_TITLE = re.compile(r"请为文档的 '(.+?)' 部分生成内容")
+_SECTION_LENGTH = re.compile(r'字数限制:\D*(\d+)')
+_DEFAULT_HEADINGS = ['基本概念', '核心原理', '典型应用', '练习与总结']
+
+
+def _text(content):
+    # 消息内容可能是字符串，也可能是 OpenAI 的多段内容列表
+    if isinstance(content, list):
+        return ''.join(part.get('text', '') for part in content if isinstance(part, dict))
+    return content or ''
+
+
+def _headings(text, limit=8):
+    """从提示词中的原文或提纲取出标题，作为回复的章节；没有标题时使用固定的章节"""
+    found = []
+    for line in text.splitlines():
+        m = _HEADING.match(line)
+        if m:
+            title = m.group(1).strip(' *#：:')
+            if title and len(title) <= 40 and title not in found:
+                found.append(title)
+        if len(found) >= limit:
+            break
+    return found or list(_DEFAULT_HEADINGS)
+
+
+def classify(messages):
+    """按系统提示和最后一条用户消息判断请求属于哪一步，返回 (步骤, 最后一条用户消息)"""
+    system = next((_text(m.get('content')) for m in messages if m.get('role') == 'system'), '')
+    prompt = next((_text(m.get('content')) for m in reversed(messages) if m.get('role') == 'user'), '')
+    if 'You will always instruct me' in system:
+        # RolePlaying 中的 user_agent：把收到的任务转述给 assistant_agent
+        return 'instruct', prompt
+    if '分解为可独立处理的部分' in system:
+        return 'decompose', prompt
+    if '内容撰写专家' in system:
+        return 'section', prompt
+    if 'json生成器' in system:
+        return 'mindmap', prompt
+    if '"domains"' in prompt and '"outline"' in prompt:
+        return 'analyze', prompt
+    if '知识领域关键词' in prompt:
+        return 'domains', prompt
+    if '提纲' in prompt:
+        return 'outline', prompt
+    return 'other', prompt
+
+
+def _outline(prompt):
+    return '\n\n'.join(
+        f"## {title}\n- {title}的基本概念与定义\n- {title}的主要知识点\n- {title}的常见例题与易错点"
+        for title in _headings(prompt)
+    )
+
+
+def _decomposition(prompt):
+    sections = {}
+    for i, title in enumerate(_headings(prompt), 1):
+        sections[f'section_{i}'] = {
+            'title': title,
+            'requirements': f'介绍{title}的核心内容，面向初学者',
+            'length': '约200字',
+            'key_points': [f'{title}的定义', f'{title}的应用'],
+        }
+    return json.dumps(sections, ensure_ascii=False, indent=4)
+
+
+def _section(prompt):
+    m = _SECTION_TITLE.search(prompt)
+    title = m.group(1) if m else '本部分'
+    m = _SECTION_LENGTH.search(prompt)
+    length = min(int(m.group(1)), 2000) if m else 200
+    sentence = f'{title}是本文档的重要内容，理解它的定义、原理和应用有助于掌握后续章节。'
+    body = (sentence * (length // len(sentence) + 1))[:length]
+    return f"Solution: {body}\n\nNext request."
+
+
+def _mind_map(prompt):
+    branches = _headings(prompt, limit=5)
+    nodes = {'知识图谱': {'children': branches, 'expanded': False, 'level': 0}}
+    for branch in branches:
+        leaves = [f'{branch}：定义', f'{branch}：应用']
+        nodes[branch] = {'children': leaves, 'expanded': False, 'level': 1}
+        for leaf in leaves:
+            nodes[leaf] = {'children': [], 'expanded': True, 'level': 2}
+    return json.dumps(nodes, ensure_ascii=False, indent=4)
+
+
+def reply(kind, prompt):
+    """返回与该步骤提示词要求的格式一致的回复文本"""
+    if kind == 'instruct':
+        return f"Instruction: {prompt}\nInput: None"
+    if kind == 'decompose':
+        return _decomposition(prompt)
+    if kind == 'section':
+        return _section(prompt)
+    if kind == 'mindmap':
+        return _mind_map(prompt)
+    if kind == 'analyze':
+        headings = _headings(prompt)
+        return json.dumps({'domains': headings[:5], 'outline': _outline(prompt)}, ensure_ascii=False)
+    if kind == 'domains':
+        return '，'.join(_headings(prompt, limit=5))
+    if kind == 'outline':
+        return _outline(prompt)
+    return '好的。'
+
+
+def corrupt(text):
+    # 模拟模型常犯的错误：JSON 中漏掉一个引号
+    i = text.rfind('",')
+    return text[:i] + text[i + 1:] if i >= 0 else text[:-1]
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.options['verbose']:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._json(200, {'object': 'list', 'data': [{'id': 'deepseek-ai/DeepSeek-V3', 'object': 'model'}]})
+        else:
+            self._json(404, {'error': {'message': f'未知路径 {self.path}', 'type': 'invalid_request_error'}})
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._json(404, {'error': {'message': f'未知路径 {self.path}', 'type': 'invalid_request_error'}})
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        options, rng = self.server.options, self.server.rng
+        kind, prompt = classify(body.get('messages', []))
+        self.server.count(kind)
+        if rng.random() < options['rate_429']:
+            self.server.count('429')
+            self._json(429, {'error': {'message': 'Rate limit exceeded', 'type': 'rate_limit_error', 'code': 429}},
+                       {'Retry-After': str(options['retry_after'])})
+            return
+        text = reply(kind, prompt)
+        if kind in ('decompose', 'mindmap', 'analyze') and rng.random() < options['malformed']:
+            self.server.count('malformed')
+            text = corrupt(text)
+        usage = {
+            'prompt_tokens': sum(estimate_tokens(_text(m.get('content'))) for m in body.get('messages', [])),
+            'completion_tokens': estimate_tokens(text),
+        }
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        time.sleep(options['latency'])
+        if body.get('stream'):
+            include_usage = (body.get('stream_options') or {}).get('include_usage')
+            self._stream(body.get('model', ''), text, usage if include_usage else None)
+        else:
+            self._sleep_tokens(usage['completion_tokens'])
+            self._json(200, {
+                'id': f'chatcmpl-{uuid.uuid4().hex}',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': body.get('model', ''),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+
+    def _sleep_tokens(self, tokens):
+        speed = self.server.options['tokens_per_sec']
+        if speed > 0:
+            time.sleep(tokens / speed)
+
+    def _json(self, status, data, headers=None):
+        payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _stream(self, model, text, usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        chunk = {'id': f'chatcmpl-{uuid.uuid4().hex}', 'object': 'chat.completion.chunk',
+                 'created': int(time.time()), 'model': model}
+
+        def send(choices, **extra):
+            data = json.dumps({**chunk, 'choices': choices, **extra}, ensure_ascii=False)
+            self.wfile.write(f'data: {data}\n\n'.encode('utf-8'))
+            self.wfile.flush()
+
+        piece = self.server.options['chunk_chars']
+        send([{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}])
+        for i in range(0, len(text), piece):
+            self._sleep_tokens(estimate_tokens(text[i:i + piece]))
+            send([{'index': 0, 'delta': {'content': text[i:i + piece]}, 'finish_reason': None}])
+        send([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+        if usage is not None:
+            send([], usage=usage)
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, tokens_per_sec=0.0, rate_429=0.0, malformed=0.0, retry_after=1,
+                 chunk_chars=4, seed=None, verbose=False):
+        super().__init__(address, FakeHandler)
+        self.options = {
+            'latency': latency, 'tokens_per_sec': tokens_per_sec, 'rate_429': rate_429, 'malformed': malformed,
+            'retry_after': retry_after, 'chunk_chars': max(1, chunk_chars), 'verbose': verbose,
+        }
+        self.rng = random.Random(seed)
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+
+def start(host='127.0.0.1', port=0, **options):
+    """在后台线程启动模拟服务并返回它，port=0 时自动选择端口；用 server.base_url 作为模型的 url，
+    结束时调用 server.shutdown()"""
+    server = FakeServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='本地模拟的 SiliconFlow（OpenAI 兼容）服务，用于离线性能测试')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='每次请求返回第一个字之前的延迟（秒）')
+    parser.add_argument('--tokens_per_sec', type=float, default=0.0, help='生成速度（token/秒），0 表示立即返回全部内容')
+    parser.add_argument('--rate_429', type=float, default=0.0, help='返回 429 限流的请求比例（0~1）')
+    parser.add_argument('--retry_after', type=int, default=1, help='429 响应中 Retry-After 的秒数')
+    parser.add_argument('--malformed', type=float, default=0.0, help='大纲分解、思维导图等 JSON 回复格式错误的比例（0~1）')
+    parser.add_argument('--chunk_chars', type=int, default=4, help='流式响应每块的字符数')
+    parser.add_argument('--seed', type=int, default=None, help='随机数种子，固定后 429 和格式错误出现的位置可复现')
+    parser.add_argument('--verbose', action='store_true', help='输出每个请求的日志')
+    args = parser.parse_args()
+
+    server = FakeServer((args.host, args.port), latency=args.latency, tokens_per_sec=args.tokens_per_sec,
+                        rate_429=args.rate_429, malformed=args.malformed, retry_after=args.retry_after,
+                        chunk_chars=args.chunk_chars, seed=args.seed, verbose=args.verbose)
+    print(f"模拟服务已启动: {server.base_url}（Ctrl+C 结束）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"请求统计: {server.counts}")
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+import re
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from email.utils import parsedate_to_datetime
+
+from openai import Stream, AsyncStream
+from camel.configs import SiliconFlowConfig
+from camel.models import ModelFactory
+from camel.types import ModelPlatformType
+
+import streaming
+import accounting
+from chunking import estimate_tokens
+
+# 供应商限流时的报错（camel 把原始异常转成 ModelProcessingError，只保留了错误信息）
+_THROTTLED = re.compile(r'\b429\b|rate.?limit|too many requests|TPM|RPM', re.IGNORECASE)
+
+
+# 没有状态码时按异常类型名和错误信息判断是否为网络超时、连接中断等暂时性错误
+_TRANSIENT = re.compile(r'timeout|timed out|connection|temporarily|overloaded|502|503|504', re.IGNORECASE)
+_STATUS = re.compile(r'Error code: (\d{3})')
+
+
+def is_throttled(exc):
+    return bool(_THROTTLED.search(str(exc)))
+
+
+def status_code(exc):
+    code = getattr(exc, 'status_code', None)
+    if code is None:
+        m = _STATUS.search(str(exc))
+        code = int(m.group(1)) if m else None
+    return code
+
+
+def is_retryable(exc):
+    """429、408 和 5xx 以及超时、连接错误值得重试；其余（如 400、401）重试也不会成功"""
+    code = status_code(exc)
+    if code is not None:
+        return code in (408, 429) or code >= 500
+    return is_throttled(exc) or bool(_TRANSIENT.search(f'{type(exc).__name__} {exc}'))
+
+
+def retry_after(exc):
+    # 供应商在 Retry-After（秒数或 HTTP 日期）或 retry-after-ms 响应头中给出的等待时间
+    headers = getattr(getattr(exc, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """令牌桶：每分钟补充 per_minute 个，最多积攒 per_minute 个；允许欠账，欠账还清前不再放行"""
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60.0)
+        self.updated = now
+
+    def wait_time(self, n, now):
+        # 还需等待多少秒才够 n 个；单次需求超过桶容量时按桶满计算
+        self._refill(now)
+        n = min(n, self.per_minute)
+        if self.level >= n:
+            return 0.0
+        return (n - self.level) * 60.0 / self.per_minute
+
+    def take(self, n):
+        self.level -= n
+
+
+class Governor:
+    """进程内共享的调速器：每分钟请求数、每分钟 token 数两个令牌桶，加上 AIMD 并发上限
+
+    每次成功的请求把并发上限加 1/limit（约每一轮并发加一），被限流时减半，
+    在供应商允许的范围内尽快发出请求，不再用固定的 sleep 等待。
+    """
+
+    def __init__(self, rpm=1000, tpm=50000, max_concurrency=8, min_concurrency=1):
+        self._cond = threading.Condition()
+        self.configure(rpm, tpm, max_concurrency, min_concurrency)
+        self.active = 0
+        self.paused_until = 0.0
+
+    def configure(self, rpm=None, tpm=None, max_concurrency=None, min_concurrency=None):
+        with self._cond:
+            if rpm is not None:
+                self.requests = TokenBucket(rpm)
+            if tpm is not None:
+                self.tokens = TokenBucket(tpm)
+            if max_concurrency is not None:
+                self.max_concurrency = max_concurrency
+                self.limit = float(max_concurrency)
+            if min_concurrency is not None:
+                self.min_concurrency = min_concurrency
+            self._cond.notify_all()
+
+    def _reserve(self, tokens, requests):
+        # 允许发出请求时占用配额并返回 0，否则返回需等待的秒数（None 表示要等其他请求结束）；调用方持有 _cond
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.active >= int(self.limit):
+            return None
+        wait = max(self.requests.wait_time(requests, now), self.tokens.wait_time(tokens, now))
+        if wait <= 0:
+            self.requests.take(requests)
+            self.tokens.take(tokens)
+            self.active += 1
+            return 0
+        return wait
+
+    def acquire(self, tokens, requests=1):
+        """等到并发、请求数和 token 数都允许时返回；requests 为这次调用会发出的模型请求数"""
+        with self._cond:
+            while True:
+                wait = self._reserve(tokens, requests)
+                if wait == 0:
+                    return
+                self._cond.wait(wait)
+
+    async def aacquire(self, tokens, requests=1, poll=0.05):
+        """acquire 的异步版本，等待时不阻塞事件循环；要等其他请求结束时每 poll 秒检查一次"""
+        while True:
+            with self._cond:
+                wait = self._reserve(tokens, requests)
+            if wait == 0:
+                return
+            await asyncio.sleep(poll if wait is None else wait)
+
+    def release(self, estimated, used=None, throttled=False):
+        """请求结束；used 为实际消耗的 token 数，与预估的差额从令牌桶中补扣或退还"""
+        with self._cond:
+            self.active -= 1
+            if used is not None:
+                self.tokens.take(used - estimated)
+            if throttled:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def pause(self, seconds):
+        """被限流后所有线程都暂停 seconds 秒再发出新请求"""
+        with self._cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+
+GOVERNOR = Governor()
+
+# 各阶段的 (单次请求最多重试次数, 每个任务内该阶段的重试总数)；请求次数多的阶段预算也多
+RETRY_POLICY = {
+    'default': (3, 10),
+    'domains': (3, 20),
+    'analyze': (3, 6),
+    'outline': (3, 20),
+    'decompose': (4, 8),
+    'section': (4, 40),
+    'mindmap': (4, 8),
+}
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+# 供应商给出的 Retry-After 超过该秒数时按该值等待，避免异常的响应头让任务停滞
+RETRY_AFTER_MAX = 120.0
+
+# 模型服务的默认地址（OpenAI 兼容接口）
+DEFAULT_URL = 'https://api.siliconflow.cn/v1'
+
+# watch() 包装的模型把原始异常记在这里；camel 转成 ModelProcessingError 时会丢掉状态码和响应头
+_last_error = contextvars.ContextVar('last_model_error', default=None)
+
+
+def configure(**kwargs):
+    GOVERNOR.configure(**kwargs)
+
+
+def _usage(result, key='total_tokens'):
+    # ChatAgent.step 返回的 response.info['usage']；RolePlaying.step 返回两个 response
+    responses = result if isinstance(result, tuple) else (result,)
+    total = 0
+    for r in responses:
+        usage = (getattr(r, 'info', None) or {}).get('usage') or {}
+        total += usage.get(key) or 0
+    return total or None
+
+
+class _Watched:
+    """流式响应的代理：camel 逐块读取时先把每一块交给 hooks；response、close 等其余属性转给原对象
+
+    子类 _Stream/_AsyncStream 同时继承 openai 的 Stream/AsyncStream，以通过 camel 对响应类型的校验，原对象不做改动。
+    """
+
+    def __init__(self, stream, hooks):
+        self._stream = stream
+        self._hooks = hooks
+        self._iterator = self.__stream__()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def _observe(self, chunk):
+        for hook in self._hooks:
+            hook(chunk)
+        return chunk
+
+
+class _Stream(_Watched, Stream):
+    def __stream__(self):
+        for chunk in self._stream:
+            yield self._observe(chunk)
+
+
+class _AsyncStream(_Watched, AsyncStream):
+    async def __stream__(self):
+        async for chunk in self._stream:
+            yield self._observe(chunk)
+
+
+def _watched(response):
+    # 非流式响应直接记录和转发；流式响应没有需要的 hook 时原样返回
+    if not isinstance(response, (Stream, AsyncStream)):
+        accounting.observe(response)
+        streaming.forward(response)
+        return response
+    hooks = [hook for hook in (accounting.observer(), streaming.forwarder()) if hook is not None]
+    if not hooks:
+        return response
+    return _AsyncStream(response, hooks) if isinstance(response, AsyncStream) else _Stream(response, hooks)
+
+
+def watch(model):
+    """包装 ModelFactory.create 返回的模型
+
+    记录请求失败时的原始异常，供 call 读取状态码和 Retry-After；流式响应的文本转发给 streaming.listen 的接收者；
+    每次请求的首字时间和供应商返回的用量记入 accounting。
+    """
+    run, arun = model.run, model.arun
+
+    def watched_run(*args, **kwargs):
+        streaming.emit('start')
+        accounting.request()
+        try:
+            return _watched(run(*args, **kwargs))
+        except Exception as e:
+            _last_error.set(e)
+            raise
+
+    async def watched_arun(*args, **kwargs):
+        streaming.emit('start')
+        accounting.request()
+        try:
+            return _watched(await arun(*args, **kwargs))
+        except Exception as e:
+            _last_error.set(e)
+            raise
+
+    model.run, model.arun = watched_run, watched_arun
+    return model
+
+
+def make_model(api_key, url=DEFAULT_URL, model_type='deepseek-ai/DeepSeek-V3', temperature=0.3):
+    """创建经 watch 包装的流式模型，所有 Agent 都通过它创建
+
+    SiliconFlow 兼容 OpenAI 接口；camel 的 SILICONFLOW 后端不支持异步请求，这里按 OpenAI 兼容接口创建。
+    重试由 call 统一负责（退避、Retry-After、各阶段预算），关闭 SDK 自带的重试。
+    n=1：RolePlaying.astep 会比较 n 的大小，不能为 None。
+    """
+    return watch(ModelFactory.create(
+        model_platform=ModelPlatformType.OPENAI_COMPATIBLE_MODEL,
+        model_type=model_type,
+        model_config_dict=SiliconFlowConfig(stream=True, temperature=temperature, n=1).as_dict(),
+        api_key=api_key,
+        url=url,
+        max_retries=0
+    ))
+
+
+def backoff(attempt, hint=None):
+    # 带随机抖动的指数退避；供应商给出 Retry-After 时至少等待这么久，但不超过 RETRY_AFTER_MAX
+    wait = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+    return max(wait, min(hint or 0, RETRY_AFTER_MAX))
+
+
+def _agents(fn):
+    # fn 为 ChatAgent.step 或 RolePlaying.step 时，返回其中带对话记忆的 Agent
+    owner = getattr(fn, '__self__', None)
+    candidates = (owner, getattr(owner, 'assistant_agent', None), getattr(owner, 'user_agent', None))
+    return [a for a in candidates if hasattr(a, 'memory')]
+
+
+def _history(agent):
+    return [r.memory_record for r in agent.memory.retrieve()]
+
+
+def _restore(agent, records):
+    # step 在请求模型之前就把提问写入了对话记忆，重试前恢复原状，避免同一提问出现两次
+    agent.memory.clear()
+    agent.memory.write_records(records)
+
+
+def _prepare(fn, prompt):
+    # 返回 (带对话记忆的 Agent, 各自的对话记录, 发送的 token 数, 预估的 token 数, 每次尝试发出的请求数)
+    text = prompt if isinstance(prompt, str) else getattr(prompt, 'content', '')
+    agents = _agents(fn)
+    histories = [_history(a) for a in agents]
+    # 每次请求都会把对话记忆中的历史消息一并发送
+    sent = estimate_tokens(text) + sum(estimate_tokens(r.message.content) for h in histories for r in h)
+    # 每个 Agent 各发出一次请求：RolePlaying.step 先后请求 user_agent 和 assistant_agent，占两个请求数配额
+    return agents, histories, sent, sent + estimate_tokens(text), max(1, len(agents))
+
+
+def _failed(e, stage, attempt, estimated, agents, histories):
+    """请求失败：恢复对话记忆，返回重试前应等待的秒数；不应重试时返回 None"""
+    error = _last_error.get() or e
+    throttled = is_throttled(error)
+    GOVERNOR.release(estimated, throttled=throttled)
+    # 无论是否重试都恢复对话记忆，放弃重试后 Agent 仍可在下次任务中继续使用
+    for agent, history in zip(agents, histories):
+        _restore(agent, history)
+    max_retries, budget = RETRY_POLICY.get(stage, RETRY_POLICY['default'])
+    if not is_retryable(error) or attempt >= max_retries or not accounting.LEDGER.take_retry(stage, budget):
+        return None
+    wait = backoff(attempt, retry_after(error))
+    if throttled:
+        GOVERNOR.pause(wait)
+    print(f"{stage} 请求失败（{error}），{wait:.1f} 秒后重试（第 {attempt + 1} 次）")
+    return wait
+
+
+def _succeeded(result, sent, estimated, entry):
+    GOVERNOR.release(estimated, _usage(result))
+    # 流式输出时供应商可能不返回用量，按本地估算记录
+    entry.finish(_usage(result, 'prompt_tokens') or sent, _usage(result, 'completion_tokens') or 0)
+    streaming.emit('end')
+    return result
+
+
+def call(fn, prompt, *args, stage='default', **kwargs):
+    """通过全局调速器调用 fn(prompt, ...)，如 call(agent.step, prompt, stage='domains')
+
+    预估的 token 数为对话记忆中的历史消息加上两倍的提示词长度（含输出），请求结束后按实际用量校正。
+    遇到限流、5xx、超时等暂时性错误时按 RETRY_POLICY[stage] 退避重试。
+    流式输出按 stage 转给 streaming.listen 的接收者，成功后发出 'end'。
+    token 数、首字时间、总耗时、重试次数、等待时间和费用记入 accounting.LEDGER。
+    """
+    agents, histories, sent, estimated, requests = _prepare(fn, prompt)
+    with streaming.in_stage(stage), accounting.track(stage) as entry:
+        attempt = 0
+        while True:
+            _last_error.set(None)
+            queued = time.monotonic()
+            GOVERNOR.acquire(estimated, requests)
+            entry.attempt(time.monotonic() - queued)
+            try:
+                result = fn(prompt, *args, **kwargs)
+            except Exception as e:
+                wait = _failed(e, stage, attempt, estimated, agents, histories)
+                if wait is None:
+                    raise
+                entry.retry(wait)
+                time.sleep(wait)
+                attempt += 1
+                continue
+            return _succeeded(result, sent, estimated, entry)
+
+
+async def acall(fn, prompt, *args, stage='default', **kwargs):
+    """call 的异步版本，fn 为协程函数，如 await acall(agent.astep, prompt, stage='section')"""
+    agents, histories, sent, estimated, requests = _prepare(fn, prompt)
+    with streaming.in_stage(stage), accounting.track(stage) as entry:
+        attempt = 0
+        while True:
+            _last_error.set(None)
+            queued = time.monotonic()
+            await GOVERNOR.aacquire(estimated, requests)
+            entry.attempt(time.monotonic() - queued)
+            try:
+                result = await fn(prompt, *args, **kwargs)
+            except Exception as e:
+                wait = _failed(e, stage, attempt, estimated, agents, histories)
+                if wait is None:
+                    raise
+                entry.retry(wait)
+                await asyncio.sleep(wait)
+                attempt += 1
+                continue
+            return _succeeded(result, sent, estimated, entry)
@@ -1,131 +1,865 @@
 # -*- coding: utf-8 -*-
 import os
-import json
+import sys
+import asyncio
 import argparse
-import time
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import NamedTuple, Optional
 from docx import Document
+from docx.text.paragraph import Paragraph
 from pptx import Presentation
+from pptx.enum.shapes import MSO_SHAPE_TYPE, PP_PLACEHOLDER
 from camel.agents import ChatAgent
-from camel.configs import SiliconFlowConfig
-from camel.models import ModelFactory
-from camel.types import ModelPlatformType
+from camel.types import OpenAIBackendRole
+from doc_cache import DocumentCache
+import ooxml
+import governor
+import streaming
+import accounting
+from chunking import estimate_tokens, split_chunks, group_by_budget
+from dedup import strip_boilerplate
+from domains import split_domains
+from structured import parse_analysis
+from memory import MemoryStore, SQLiteMemoryStore, content_hash, open_memory
+
+class Block(NamedTuple):
+    # 文档中的一个文本块：幻灯片序号（docx/txt 为 None）、块序号、标题级别（0 为正文）、文本
+    slide: Optional[int]
+    paragraph: int
+    heading: int
+    text: str
+
+
+_TITLE_PLACEHOLDERS = (PP_PLACEHOLDER.TITLE, PP_PLACEHOLDER.CENTER_TITLE, PP_PLACEHOLDER.VERTICAL_TITLE)
+
+
+def _placeholder_type(shape):
+    if not shape.is_placeholder:
+        return None
+    try:
+        return shape.placeholder_format.type
+    except ValueError:
+        return None
+
+
+def _iter_shape_paragraphs(shapes):
+    # 按形状顺序产出 (标题级别, 段落)，递归进入组合形状和表格
+    for shape in shapes:
+        if shape.shape_type == MSO_SHAPE_TYPE.GROUP:
+            yield from _iter_shape_paragraphs(shape.shapes)
+        elif shape.has_text_frame:
+            placeholder = _placeholder_type(shape)
+            if placeholder == PP_PLACEHOLDER.SLIDE_NUMBER:
+                # 页码占位符中是 PowerPoint 自动填写的页码，不是正文
+                continue
+            heading = 1 if placeholder in _TITLE_PLACEHOLDERS else 0
+            for p in shape.text_frame.paragraphs:
+                yield heading, p
+        elif getattr(shape, 'has_table', False) and shape.has_table:
+            for row in shape.table.rows:
+                for cell in row.cells:
+                    for p in cell.text_frame.paragraphs:
+                        yield 0, p
+
+
+def blocks_to_text(blocks):
+    return '\n'.join(b.text for b in blocks)
+
+
+def split_units(blocks):
+    """把块分成再次导入时比较差异的单位：pptx 每张幻灯片一个，docx/txt 每段一个
+
+    返回 [(内容哈希, 文本)]，哈希只取前 16 位，足以区分同一文档中的单位。
+    空白的段落或幻灯片不算单位，否则任意两个文档都会因为空段落而显得相同。
+    """
+    groups = []
+    for b in blocks:
+        if groups and b.slide is not None and groups[-1][0] == b.slide:
+            groups[-1][1].append(b.text)
+        else:
+            groups.append((b.slide, [b.text]))
+    texts = ('\n'.join(lines) for _, lines in groups)
+    return [(content_hash(text)[:16], text) for text in texts if text.strip()]
+
+
+_EMPTY_UNIT = content_hash('')[:16]
+
+# 解析逻辑变化时递增，使旧的缓存失效
+LOADER_VERSION = 4
+
 
 class DocumentLoader:
-    def load(self, path):
+    def __init__(self, cache=None, fast=False):
+        # cache 为 doc_cache.DocumentCache，命中时无需重新解析文件
+        # fast=True 时 docx/pptx 直接流式解析 XML（见 ooxml.py），不经过 python-docx/python-pptx
+        self.cache = cache
+        self.fast = fast
+
+    def iter_blocks(self, path):
+        """逐块读取文档，按幻灯片/段落顺序惰性产出 Block"""
+        if self.cache is None:
+            return self._iter_blocks(path)
+        return self._iter_cached(path)
+
+    def _iter_cached(self, path):
+        # 两种解析方式分别缓存，互不混用
+        key = self.cache.key(path, f'{LOADER_VERSION}-fast' if self.fast else LOADER_VERSION)
+        cached = self.cache.get(key)
+        if cached is not None:
+            yield from (Block(*b) for b in cached)
+            return
+        blocks = []
+        for b in self._iter_blocks(path):
+            blocks.append(b)
+            yield b
+        self.cache.put(key, blocks)
+
+    def _iter_blocks(self, path):
         ext = os.path.splitext(path)[1].lower()
+        if self.fast and ext in ('.docx', '.pptx'):
+            return (Block._make(b) for b in ooxml.iter_blocks(path))
         if ext == '.txt':
-            with open(path, 'r', encoding='utf-8') as f:
-                return f.read()
+            return self._iter_txt(path)
         if ext in ('.doc', '.docx'):
-            doc = Document(path)
-            return '\n'.join(p.text for p in doc.paragraphs)
+            return self._iter_docx(path)
         if ext == '.pptx':
-            prs = Presentation(path)
-            texts = []
-            for slide in prs.slides:
-                for shape in slide.shapes:
-                    if hasattr(shape, 'text'):
-                        texts.append(shape.text)
-            return '\n'.join(texts)
+            return self._iter_pptx(path)
         raise ValueError(f'Unsupported format: {ext}')
 
-class MemoryStore:
-    def __init__(self, path='memory.json'):
-        self.path = path
-        if os.path.exists(path):
-            with open(path, 'r', encoding='utf-8') as f:
-                self.data = json.load(f)
-            # 确保所有字段存在
-            self.data.setdefault('domains', [])
-            self.data.setdefault('documents', [])
+    def load(self, path):
+        return blocks_to_text(self.iter_blocks(path))
+
+    def _iter_txt(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                line = line.rstrip('\n')
+                # 兼容 markdown 风格的 # 标题
+                stripped = line.lstrip()
+                level = len(stripped) - len(stripped.lstrip('#'))
+                heading = level if 0 < level <= 6 and stripped[level:level + 1] == ' ' else 0
+                yield Block(None, i, heading, line)
+
+    def _iter_docx(self, path):
+        doc = Document(path)
+        # doc.paragraphs 不含表格和文本框中的段落，这里按文档顺序遍历全部段落；
+        # Paragraph.text 不含修订插入、域等包着的文字，文字与快速解析一样由 ooxml.paragraph_text 提取
+        for i, p in enumerate(ooxml.iter_paragraphs(doc.element.body)):
+            style = Paragraph(p, doc).style
+            yield Block(None, i, ooxml.heading_level(style.name if style is not None else ''), ooxml.paragraph_text(p))
+
+    def _iter_pptx(self, path):
+        prs = Presentation(path)
+        for s, slide in enumerate(prs.slides):
+            i = 0
+            for heading, p in _iter_shape_paragraphs(slide.shapes):
+                yield Block(s, i, heading, p.text)
+                i += 1
+            # 演讲者备注
+            if slide.has_notes_slide and slide.notes_slide.notes_text_frame is not None:
+                for p in slide.notes_slide.notes_text_frame.paragraphs:
+                    yield Block(s, i, 0, p.text)
+                    i += 1
+
+def extract_outline(blocks, min_nodes=2):
+    """根据 docx 标题样式、pptx 幻灯片标题直接构建章节树，不调用模型
+
+    返回节点列表，每个节点为 {'title', 'level', 'points', 'children'}；
+    文档中可识别的标题少于 min_nodes 个时返回 None，交由模型生成提纲。
+    """
+    roots = []
+    stack = []
+    count = 0
+    prev = None
+    for b in blocks:
+        text = b.text.strip()
+        if not text:
+            continue
+        if b.heading and prev is not None and prev.heading == b.heading and b.slide is not None and prev.slide == b.slide:
+            # 同一张幻灯片标题中的多个段落合并为一个标题
+            stack[-1]['title'] += ' ' + text
+        elif b.heading:
+            node = {'title': text.lstrip('#').strip(), 'level': b.heading, 'points': [], 'children': []}
+            # 弹出同级及更深的节点，找到父节点
+            while stack and stack[-1]['level'] >= b.heading:
+                stack.pop()
+            (stack[-1]['children'] if stack else roots).append(node)
+            stack.append(node)
+            count += 1
+        elif stack:
+            stack[-1]['points'].append(text)
+        # 第一个标题之前的正文（如封面信息）不计入提纲
+        prev = b
+    return roots if count >= min_nodes else None
+
+
+def split_sections(text):
+    # 按顶层章节（## 标题）拆分提纲，第一个标题之前的内容并入第一节
+    sections = []
+    for line in text.strip().split('\n'):
+        if line.startswith('## ') or not sections:
+            sections.append([line])
         else:
-            # 初始化包括 domains 的数据结构
-            self.data = {'domains': [], 'documents': []}
-            self._save()
-
-    def add_domain(self, domain):
-        if domain and domain not in self.data['domains']:
-            self.data['domains'].append(domain)
-            self._save()
-
-    def add_document(self, text):
-        if text and text not in self.data['documents']:
-            self.data['documents'].append(text)
-            self._save()
-
-    def get_context(self):
-        # 将 domains, documents 一并作为上下文
-        domains = '\n'.join(self.data.get('domains', []))
-        docs = '\n'.join(self.data.get('documents', []))
-        return (
-            f'已了解知识领域：\n{domains}\n'
-            f'已提交文档：\n{docs}\n'
-        )
+            sections[-1].append(line)
+    if len(sections) > 1 and not sections[0][0].startswith('## '):
+        sections[1] = sections[0] + sections[1]
+        del sections[0]
+    return ['\n'.join(lines).strip() for lines in sections]
+
+
+class OutlineCache:
+    """提纲片段缓存：以送入模型的内容哈希为键保存模型输出
+
+    文档修改后再次生成提纲时，内容没有变化的章节或分块直接沿用上次的结果。
+    parts 为本次用到的全部片段，保存后供下次使用。
+    """
+
+    def __init__(self, parts=None):
+        self.old = dict(parts or {})
+        self.parts = {}
+
+    @staticmethod
+    def _key(kind, text):
+        return f'{kind}:{content_hash(text)[:16]}'
+
+    def get(self, kind, text):
+        key = self._key(kind, text)
+        value = self.old.get(key)
+        if value is not None:
+            self.parts[key] = value
+        return value
+
+    def put(self, kind, text, value):
+        self.parts[self._key(kind, text)] = value
+
+    def run(self, kind, text, fn):
+        value = self.get(kind, text)
+        if value is None:
+            value = fn()
+            self.put(kind, text, value)
+        return value
+
+
+def render_outline(nodes, max_points=3, max_chars=60):
+    # 将章节树渲染为 markdown；max_points 为 None 时保留全部正文
+    lines = []
+
+    def walk(node, depth):
+        lines.append(f"{'#' * min(depth + 2, 6)} {node['title']}")
+        points = node['points'] if max_points is None else node['points'][:max_points]
+        for p in points:
+            p = ' '.join(p.split())
+            lines.append(f"- {p if max_chars is None else p[:max_chars]}")
+        lines.append('')
+        for child in node['children']:
+            walk(child, depth + 1)
+
+    for node in nodes:
+        walk(node, 0)
+    return '\n'.join(lines).strip()
 
-    def _save(self):
-        with open(self.path, 'w', encoding='utf-8') as f:
-            json.dump(self.data, f, ensure_ascii=False, indent=2)
 
 class LearningAgent:
-    def __init__(self, api_key):
+    """为学生生成学习提纲、提取知识领域的 Agent
+
+    history 决定主 Agent 的对话记忆：'fresh' 每次请求使用新的对话，只发送系统提示和本次提示词；
+    'window' 保留最近的若干轮对话，总量不超过 history_tokens；'full' 保留全部对话。
+    跨文档的背景知识由记忆上下文（get_context）提供，通常不需要保留对话。
+    """
+
+    HISTORY_MODES = ('fresh', 'window', 'full')
+
+    def __init__(self, api_key, chunk_tokens=6000, chunk_overlap=300, max_workers=4, fan_in=4, history='fresh',
+                 history_tokens=4000, base_url=governor.DEFAULT_URL):
+        if history not in self.HISTORY_MODES:
+            raise ValueError(f'history 应为 {self.HISTORY_MODES} 之一')
         # 主 Agent：生成面向学生的全面提纲
         sys_msg = (
             '你是一个学习助手，请用简洁的中文，根据学生身份，'
             '为学生生成面向学习的全面提纲，包括各章节或板块名称及对应主要知识点摘要，'
             '不要输出教学目标、课时安排或其他教学设计内容。'
         )
-        model = ModelFactory.create(
-            model_platform=ModelPlatformType.SILICONFLOW,
-            model_type='deepseek-ai/DeepSeek-V3',
-            model_config_dict=SiliconFlowConfig(stream=True, temperature=0.3).as_dict(),
-            api_key=api_key
-        )
-        self.agent = ChatAgent(system_message=sys_msg, model=model, output_language='中文')
+        self.sys_msg = sys_msg
+        self.model = governor.make_model(api_key, base_url)
+        self.agent = self._new_agent()
+        self.history = history
+        self.history_tokens = history_tokens
+        # 超过 chunk_tokens 的文档分块并发生成局部提纲，再每 fan_in 份逐层合并
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap = chunk_overlap
+        self.max_workers = max_workers
+        self.fan_in = fan_in
 
-    def extract_domains(self, content, memory_context):
-        # 使用主 Agent 提取该文档的知识领域
-        prompt = (
-            f"{memory_context}\n"
-            f"请从以下内容中提取简洁的知识领域关键词列表（以逗号或换行分隔）：\n{content}"
-        )
-        resp = self.agent.step(prompt).msg.content
-        # 粗略拆分关键词
-        domains = [d.strip() for d in resp.replace('，', ',').split(',') if d.strip()]
-        time.sleep(30)
-        return domains
+    def _new_agent(self):
+        return ChatAgent(system_message=self.sys_msg, model=self.model, output_language='中文')
+
+    def _conversation(self):
+        # 按 history 返回本次请求使用的 Agent；同一方法内的追问（如 analyze 的改正请求）沿用同一个 Agent
+        if self.history == 'fresh':
+            return self._new_agent()
+        if self.history == 'window':
+            self._trim_history()
+        return self.agent
+
+    def _trim_history(self):
+        # 从最近的消息往前保留，总量不超过 history_tokens；保留的历史从一条提问开始，不拆开一问一答
+        records = [r.memory_record for r in self.agent.memory.retrieve()]
+        system = [r for r in records if r.role_at_backend == OpenAIBackendRole.SYSTEM]
+        dialog = [r for r in records if r.role_at_backend != OpenAIBackendRole.SYSTEM]
+        keep, used = len(dialog), 0
+        while keep > 0 and used + estimate_tokens(dialog[keep - 1].message.content) <= self.history_tokens:
+            keep -= 1
+            used += estimate_tokens(dialog[keep].message.content)
+        while keep < len(dialog) and dialog[keep].role_at_backend != OpenAIBackendRole.USER:
+            keep += 1
+        if keep:
+            self.agent.memory.clear()
+            self.agent.memory.write_records(system + dialog[keep:])
+
+    @staticmethod
+    def _ask(agent, prompt, stage):
+        # 所有请求都经过进程内共享的调速器，按供应商的限额尽快发出，暂时性错误按 stage 的预算重试
+        return governor.call(agent.step, prompt, stage=stage).msg.content
+
+    @staticmethod
+    async def _aask(agent, prompt, stage):
+        return (await governor.acall(agent.astep, prompt, stage=stage)).msg.content
+
+    def extract_domains(self, content, memory_context, isolated=False):
+        # 使用主 Agent 提取该文档的知识领域；isolated=True 时使用独立的 Agent，便于多线程并发调用
+        agent = self._new_agent() if isolated else self._conversation()
+        resp = self._ask(agent, _domains_prompt(content, memory_context), 'domains')
+        # 拆分并清理关键词
+        return split_domains(resp)
+
+    async def aextract_domains(self, content, memory_context, isolated=False):
+        # extract_domains 的异步版本，多个文档可以在同一个事件循环中同时提取
+        agent = self._new_agent() if isolated else self._conversation()
+        return split_domains(await self._aask(agent, _domains_prompt(content, memory_context), 'domains'))
+
+    def analyze(self, content, memory_context, isolated=False):
+        """一次请求同时提取知识领域并生成学习提纲，返回 (知识领域列表, 提纲)
+
+        文档和记忆上下文只发送一次。回复须为 JSON，本地校验不通过时在同一对话中要求模型改正一次，
+        改正请求不再附带文档；仍不合格时改用 extract_domains 和提纲请求分别生成，不让整个导入失败。
+        """
+        agent = self._new_agent() if isolated else self._conversation()
+        reply = self._ask(agent, _analyze_prompt(content, memory_context), 'analyze')
+        try:
+            return parse_analysis(reply)
+        except ValueError as e:
+            reply = self._ask(agent, _correction_prompt(e), 'analyze')
+        try:
+            return parse_analysis(reply)
+        except ValueError as e:
+            print(f"合并请求的回复仍不符合要求（{e}），改为分别提取知识领域和生成提纲")
+        domains = self.extract_domains(content, memory_context, isolated)
+        outline_agent = self._new_agent() if isolated else self._conversation()
+        return domains, self._ask(outline_agent, _outline_prompt(content, memory_context), 'outline')
+
+    async def aanalyze(self, content, memory_context, isolated=False):
+        # analyze 的异步版本
+        agent = self._new_agent() if isolated else self._conversation()
+        reply = await self._aask(agent, _analyze_prompt(content, memory_context), 'analyze')
+        try:
+            return parse_analysis(reply)
+        except ValueError as e:
+            reply = await self._aask(agent, _correction_prompt(e), 'analyze')
+        try:
+            return parse_analysis(reply)
+        except ValueError as e:
+            print(f"合并请求的回复仍不符合要求（{e}），改为分别提取知识领域和生成提纲")
+        domains = await self.aextract_domains(content, memory_context, isolated)
+        outline_agent = self._new_agent() if isolated else self._conversation()
+        return domains, await self._aask(outline_agent, _outline_prompt(content, memory_context), 'outline')
+
+    def single_pass(self, blocks, mode='auto'):
+        # outline(blocks, mode) 是否只需一次根据全文生成提纲的请求；是则可以用 analyze 与领域提取合并
+        if mode == 'local' or (mode != 'llm' and extract_outline(blocks) is not None):
+            return False
+        return len(split_chunks(blocks_to_text(blocks), self.chunk_tokens, self.chunk_overlap)) == 1
 
     def generate_outline(self, content, memory_context):
         # 生成学生全面学习提纲
-        prompt = (
-            f"{memory_context}\n"
-            f"请根据以下内容，为学生生成全面的学习提纲，列出每个章节或板块标题及其主要知识点：\n{content}"
-        )
-        return self.agent.step(prompt).msg.content
+        return self._ask(self._conversation(), _outline_prompt(content, memory_context), 'outline')
+
+    def generate_outline_chunked(self, content, memory_context, cache=None):
+        """长文档：按 token 预算分块，各块并发生成局部提纲，再逐层合并为一份提纲"""
+        cache = cache or OutlineCache()
+        chunks = split_chunks(content, self.chunk_tokens, self.chunk_overlap)
+        if len(chunks) == 1:
+            return cache.run('full', content, lambda: self.generate_outline(content, memory_context))
+        print(f"文档约 {estimate_tokens(content)} tokens，分为 {len(chunks)} 块生成提纲")
+
+        def map_chunk(args):
+            i, chunk = args
+            prompt = _map_prompt(chunk, i, len(chunks))
+            return cache.run('map', chunk, lambda: self._ask(self._new_agent(), prompt, 'outline'))
+
+        def reduce_group(args):
+            group, final = args
+            parts, prompt = _merge_prompt(group, memory_context if final else '')
+            # 各局部提纲都沿用上次结果时，合并结果也可以沿用
+            return cache.run('reduce' if final else 'merge', parts,
+                             lambda: self._ask(self._new_agent(), prompt, 'outline'))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            parts = list(pool.map(map_chunk, enumerate(chunks)))
+            # 逐层合并，直到只剩一份；最后一次合并在当前线程进行，其流式输出可以转发给界面（见 streaming.listen）
+            while len(parts) > 1:
+                groups = [parts[i:i + self.fan_in] for i in range(0, len(parts), self.fan_in)]
+                if len(groups) == 1:
+                    parts = [reduce_group((groups[0], True))]
+                else:
+                    parts = list(pool.map(reduce_group, [(g, False) for g in groups]))
+        return parts[0]
+
+    async def agenerate_outline(self, content, memory_context, cache=None):
+        """generate_outline_chunked 的异步版本：各块和各组的合并请求在同一个事件循环中并发
+
+        并发的请求不转发流式输出（各块的文本会交错），只有单块文档或最后一次合并的请求转发。
+        """
+        cache = cache or OutlineCache()
+        chunks = split_chunks(content, self.chunk_tokens, self.chunk_overlap)
+
+        async def run(kind, text, prompt, agent):
+            value = cache.get(kind, text)
+            if value is None:
+                value = await self._aask(agent, prompt, 'outline')
+                cache.put(kind, text, value)
+            return value
+
+        if len(chunks) == 1:
+            return await run('full', content, _outline_prompt(content, memory_context), self._conversation())
+        print(f"文档约 {estimate_tokens(content)} tokens，分为 {len(chunks)} 块生成提纲")
+
+        def reduce_group(group, final):
+            parts, prompt = _merge_prompt(group, memory_context if final else '')
+            return run('reduce' if final else 'merge', parts, prompt, self._new_agent())
+
+        with streaming.listen(None):
+            parts = await asyncio.gather(*(run('map', c, _map_prompt(c, i, len(chunks)), self._new_agent())
+                                           for i, c in enumerate(chunks)))
+        while len(parts) > 1:
+            groups = [parts[i:i + self.fan_in] for i in range(0, len(parts), self.fan_in)]
+            if len(groups) == 1:
+                parts = [await reduce_group(groups[0], True)]
+            else:
+                with streaming.listen(None):
+                    parts = await asyncio.gather(*(reduce_group(g, False) for g in groups))
+        return parts[0]
+
+    def _fill_plan(self, nodes, cache):
+        # 返回 (各顶层章节的结构和原文, 各章已有的摘要, 需要请求的分组)；分组为空时全部沿用上次的摘要
+        skeletons = [render_outline([n], max_points=None, max_chars=None) for n in nodes]
+        filled = [cache.get('fill', s) for s in skeletons]
+        todo = [i for i, f in enumerate(filled) if f is None]
+        groups = group_by_budget(todo, self.chunk_tokens, lambda i: estimate_tokens(skeletons[i])) if todo else []
+        return skeletons, filled, groups
+
+    @staticmethod
+    def _fill_apply(reply, group, skeletons, filled, cache):
+        sections = split_sections(reply)
+        if len(sections) == len(group):
+            for i, section in zip(group, sections):
+                filled[i] = section
+                cache.put('fill', skeletons[i], section)
+        else:
+            # 模型没有保持章节结构，无法逐章对应，整段放在该组第一章的位置，不缓存
+            filled[group[0]] = reply
+            for i in group[1:]:
+                filled[i] = ''
+
+    def fill_outline(self, nodes, memory_context, cache=None):
+        # 章节结构已知，只请模型为每个节点补充知识点摘要
+        # 结构很大时按顶层章节分组并发补充，各组结果按顺序拼接即可
+        # 给出 cache 时，原文没有变化的顶层章节沿用上次的摘要，只补充变化的章节
+        cache = cache or OutlineCache()
+        skeletons, filled, groups = self._fill_plan(nodes, cache)
+
+        def fill(group, agent):
+            reply = self._ask(agent, _fill_prompt(group, skeletons, memory_context), 'outline')
+            self._fill_apply(reply, group, skeletons, filled, cache)
+
+        if len(groups) == 1 and len(groups[0]) == len(nodes):
+            fill(groups[0], self._conversation())
+        elif groups:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                list(pool.map(lambda g: fill(g, self._new_agent()), groups))
+        return '\n\n'.join(f for f in filled if f)
+
+    async def afill_outline(self, nodes, memory_context, cache=None):
+        # fill_outline 的异步版本；多个分组并发时不转发流式输出
+        cache = cache or OutlineCache()
+        skeletons, filled, groups = self._fill_plan(nodes, cache)
+
+        async def fill(group, agent):
+            reply = await self._aask(agent, _fill_prompt(group, skeletons, memory_context), 'outline')
+            self._fill_apply(reply, group, skeletons, filled, cache)
+
+        if len(groups) == 1 and len(groups[0]) == len(nodes):
+            await fill(groups[0], self._conversation())
+        elif groups:
+            with streaming.listen(None):
+                await asyncio.gather(*(fill(g, self._new_agent()) for g in groups))
+        return '\n\n'.join(f for f in filled if f)
+
+    def outline(self, blocks, memory_context, mode='auto', cache=None):
+        """生成学习提纲
+
+        mode: 'llm' 由模型根据全文生成；'fill' 本地提取章节结构，模型只补充知识点；
+        'local' 完全本地生成，不调用模型；'auto' 能提取到章节结构时同 'fill'，否则同 'llm'。
+        cache 为 OutlineCache，内容没有变化的部分沿用上次生成的结果。
+        """
+        nodes = extract_outline(blocks) if mode != 'llm' else None
+        if nodes is None:
+            return self.generate_outline_chunked(blocks_to_text(blocks), memory_context, cache)
+        if mode == 'local':
+            return render_outline(nodes)
+        return self.fill_outline(nodes, memory_context, cache)
+
+    async def aoutline(self, blocks, memory_context, mode='auto', cache=None):
+        # outline 的异步版本
+        nodes = extract_outline(blocks) if mode != 'llm' else None
+        if nodes is None:
+            return await self.agenerate_outline(blocks_to_text(blocks), memory_context, cache)
+        if mode == 'local':
+            return render_outline(nodes)
+        return await self.afill_outline(nodes, memory_context, cache)
+
+
+def _domains_prompt(content, memory_context):
+    return (
+        f"{memory_context}\n"
+        f"请从以下内容中提取简洁的知识领域关键词列表（以逗号或换行分隔）：\n{content}"
+    )
+
+
+def _outline_prompt(content, memory_context):
+    return (
+        f"{memory_context}\n"
+        f"请根据以下内容，为学生生成全面的学习提纲，列出每个章节或板块标题及其主要知识点：\n{content}"
+    )
+
+
+def _analyze_prompt(content, memory_context):
+    return (
+        f"{memory_context}\n"
+        f"请阅读以下内容，完成两项任务：1. 提取简洁的知识领域关键词；"
+        f"2. 为学生生成全面的学习提纲，列出每个章节或板块标题及其主要知识点。\n"
+        f'只输出一个 JSON 对象，格式为 {{"domains": ["关键词", ...], "outline": "markdown 格式的提纲"}}，'
+        f"不要输出其他内容：\n{content}"
+    )
+
+
+def _correction_prompt(error):
+    # analyze 的回复校验不通过时的改正请求，不再附带文档
+    return f'上一条回复不符合要求（{error}）。请只输出 JSON 对象 {{"domains": [...], "outline": "..."}}。'
+
+
+def _map_prompt(chunk, i, total):
+    return (
+        f"以下是一份文档的第 {i + 1}/{total} 部分，"
+        f"请为这一部分生成学习提纲，列出章节或板块标题及其主要知识点：\n{chunk}"
+    )
+
+
+def _merge_prompt(group, memory_context):
+    # 返回 (拼接后的局部提纲, 提示词)；拼接结果用作缓存键
+    parts = '\n\n'.join(f"【第 {j + 1} 份】\n{p}" for j, p in enumerate(group))
+    return parts, (
+        f"{memory_context}\n"
+        f"以下是同一文档按顺序排列的若干份局部提纲（相邻部分可能有重叠），"
+        f"请去除重复，按原顺序合并为一份完整的学习提纲，列出每个章节或板块标题及其主要知识点：\n{parts}"
+    )
+
+
+def _fill_prompt(group, skeletons, memory_context):
+    skeleton = '\n\n'.join(skeletons[i] for i in group)
+    return (
+        f"{memory_context}\n"
+        f"以下是文档已有的章节结构，每个标题下附有原文。请保持标题文字和层级不变，"
+        f"把每个标题下的原文替换为简洁的主要知识点摘要，输出完整的学习提纲：\n{skeleton}"
+    )
+
+def _parse_file(loader, path, clean=True):
+    # 在子进程中解析单个文件，并去除幻灯片中重复的页脚、页码和近似重复的幻灯片
+    blocks = list(loader.iter_blocks(path))
+    if not clean:
+        return blocks, None
+    return strip_boilerplate(blocks)
+
+
+class _Ingestion:
+    """ingest 和 aingest 共用的导入状态：各文件的块、文本、单位、旧版本，以及提取到的知识领域和提纲"""
+
+    def __init__(self, paths, mem, agent, context_tokens, outline_mode):
+        self.paths = paths
+        self.mem = mem
+        self.agent = agent
+        self.context_tokens = context_tokens
+        self.outline_mode = outline_mode
+        self.results = [None] * len(paths)
+        self.texts = [None] * len(paths)
+        self.units = [None] * len(paths)
+        self.previous = [None] * len(paths)
+        self.domains = {}
+        self.outlines = {}
+
+    def prepare(self, i, parsed):
+        """处理解析完成的第 i 个文件；需要请求模型时返回 (是否用 analyze, 文本, 记忆上下文)，否则返回 None"""
+        mem = self.mem
+        blocks, stats = parsed
+        print(f"加载文件: {self.paths[i]}")
+        if stats and stats['tokens_saved']:
+            print(f"去除重复内容 {stats['lines_removed']} 行、重复幻灯片 {stats['slides_removed']} 张，"
+                  f"节省约 {stats['tokens_saved']}/{stats['tokens_before']} tokens")
+        self.results[i] = blocks
+        text = self.texts[i] = blocks_to_text(blocks)
+        units = self.units[i] = split_units(blocks)
+        prev = _previous_version(mem, os.path.basename(self.paths[i]), units)
+        exclude = ()
+        if prev is not None:
+            self.previous[i] = prev
+            seen = set(prev['units'])
+            changed = [t for h, t in units if h not in seen]
+            if not any(t.strip() for t in changed):
+                print("内容与上次导入的版本相同，沿用已记忆的知识领域")
+                self.domains[i] = []
+                return None
+            print(f"与上次导入的版本相比有 {len(changed)}/{len(units)} 处修改，只对修改部分提取知识领域")
+            text = '\n'.join(changed)
+            exclude = (prev['id'],)
+        else:
+            dup = mem.find_duplicate(text)
+            if dup is not None:
+                print(f"与已记忆的文档 {dup[:8]} 内容相同或近似，不再重复提取知识领域")
+                self.domains[i] = []
+                return None
+        context = mem.get_context(text, self.context_tokens, exclude)
+        analyze = (self.outline_mode is not None and i == len(self.paths) - 1 and prev is None
+                   and not OutlineCache(mem.get_outline(content_hash(text))).get('full', text)
+                   and self.agent.single_pass(blocks, self.outline_mode))
+        return analyze, text, context
+
+    def collect(self, i, result):
+        # result 为 extract_domains 的知识领域列表，或 analyze 的 (知识领域列表, 提纲)
+        if isinstance(result, tuple):
+            self.domains[i], self.outlines[i] = result
+        else:
+            self.domains[i] = result
+
+    def commit(self):
+        """按输入顺序记忆文档和知识领域，整批提交；返回与 paths 顺序一致的块列表"""
+        mem = self.mem
+        with mem.batch():
+            for i, path in enumerate(self.paths):
+                text = self.texts[i]
+                title = os.path.basename(path)
+                unit_ids = [h for h, _ in self.units[i]]
+                prev = self.previous[i]
+                if prev is None or prev['id'] == content_hash(text):
+                    doc_id = mem.add_document(text, title, unit_ids)
+                    mem.add_domains(self.domains[i], doc_id)
+                    if i in self.outlines and doc_id == content_hash(text):
+                        # 与 generate_outline_chunked 的单块结果使用同一个缓存键
+                        cache = OutlineCache()
+                        cache.put('full', text, self.outlines[i])
+                        mem.set_outline(doc_id, cache.parts)
+                    continue
+                # 新版本继承旧版本的知识领域和提纲片段；先删除旧版本，否则新版本会被当作它的近似重复
+                outline = mem.get_outline(prev['id'])
+                mem.forget(prev['id'])
+                doc_id = mem.add_document(text, title, unit_ids)
+                mem.add_domains(prev['domains'] + self.domains[i], doc_id)
+                if outline and not mem.get_outline(doc_id):
+                    mem.set_outline(doc_id, outline)
+        return self.results
+
+
+def ingest(paths, loader, mem, agent, max_workers=None, max_in_flight=4, clean=True, context_tokens=2000,
+           outline_mode=None):
+    """批量导入文档：进程池并行解析，解析完成的文件立即并发提取知识领域
+
+    同时进行的领域提取请求不超过 max_in_flight 个。返回与 paths 顺序一致的块列表。
+    clean=True 时在送入模型前去除幻灯片中的重复内容；context_tokens 为每次请求附带的记忆上下文预算。
+    所有文档和领域在全部提取完成后一次性写入记忆，任一步失败时记忆保持导入前的状态。
+
+    记忆中已有同名文档、且大部分段落或幻灯片相同时视为该文档的新版本：只对修改过的部分提取
+    知识领域，与旧版本的领域合并，沿用旧版本的提纲片段，并从记忆中删除旧版本。
+    与已保存文档内容相同或近似重复（如同一课件的 pptx 和导出的 docx）的文件不再提取知识领域，
+    只记录为已有文档的副本。
+
+    给出 outline_mode 时，若最后一个文档的提纲需要由模型根据全文生成（见 LearningAgent.single_pass），
+    用 analyze 一次请求同时得到知识领域和提纲，提纲存入记忆，之后的 make_outline 直接使用。
+    """
+    paths = list(paths)
+    state = _Ingestion(paths, mem, agent, context_tokens, outline_mode)
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_in_flight) as llm_pool:
+        def dispatch(i, parsed):
+            request = state.prepare(i, parsed)
+            if request is not None:
+                analyze, text, context = request
+                fn = agent.analyze if analyze else agent.extract_domains
+                pending[llm_pool.submit(fn, text, context, True)] = i
+
+        if len(paths) == 1:
+            # 单个文件不值得启动进程池
+            dispatch(0, _parse_file(loader, paths[0], clean))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as parse_pool:
+                futures = {parse_pool.submit(_parse_file, loader, p, clean): i for i, p in enumerate(paths)}
+                for fut in as_completed(futures):
+                    dispatch(futures[fut], fut.result())
+
+        for fut in as_completed(pending):
+            state.collect(pending[fut], fut.result())
+    return state.commit()
+
+
+async def aingest(paths, loader, mem, agent, max_workers=None, max_in_flight=4, clean=True, context_tokens=2000,
+                  outline_mode=None):
+    """ingest 的异步版本：解析仍在进程池中进行，知识领域提取（或 analyze）的请求在事件循环中并发，
+    同时进行的不超过 max_in_flight 个，不再为每个请求占用一个线程
+
+    读写记忆（查重、检索上下文、最后整批提交）在线程中依次进行，不阻塞事件循环。
+    """
+    paths = list(paths)
+    state = _Ingestion(paths, mem, agent, context_tokens, outline_mode)
+    limit = asyncio.Semaphore(max_in_flight)
+    tasks = []
+
+    async def request(i, analyze, text, context):
+        async with limit:
+            fn = agent.aanalyze if analyze else agent.aextract_domains
+            state.collect(i, await fn(text, context, True))
+
+    async def dispatch(i, parsed):
+        req = await asyncio.to_thread(state.prepare, i, parsed)
+        if req is not None:
+            tasks.append(asyncio.create_task(request(i, *req)))
+
+    try:
+        if len(paths) == 1:
+            await dispatch(0, await asyncio.to_thread(_parse_file, loader, paths[0], clean))
+        else:
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor(max_workers=max_workers) as parse_pool:
+                async def parse(i, path):
+                    return i, await loop.run_in_executor(parse_pool, _parse_file, loader, path, clean)
+
+                for fut in asyncio.as_completed([parse(i, p) for i, p in enumerate(paths)]):
+                    await dispatch(*await fut)
+        await asyncio.gather(*tasks)
+    finally:
+        # 出错时取消其余的请求
+        for task in tasks:
+            task.cancel()
+    return await asyncio.to_thread(state.commit)
+
+
+def _previous_version(mem, title, units, min_overlap=0.5):
+    # 同名且两个版本中不同的非空段落或幻灯片至少 min_overlap 相同，才视为同一文档的旧版本；
+    # 旧版本随后会被删除，按较多的一方计算比例，避免误删不同文件夹下的同名文件
+    prev = mem.find_document(title)
+    if prev is None or not prev.get('units'):
+        return None
+    current = {h for h, _ in units}
+    # 早期保存的单位中可能有空段落的哈希
+    old = set(prev['units']) - {_EMPTY_UNIT}
+    if not current or not old:
+        return None
+    return prev if len(current & old) >= min_overlap * max(len(current), len(old)) else None
+
+
+@contextmanager
+def _stored_outline(mem, content):
+    """产出文档已保存的提纲片段（OutlineCache），退出时保存本次用到的片段"""
+    doc_id = content_hash(content)
+    cache = OutlineCache(mem.get_outline(doc_id))
+    # 作为副本链接到其他文档的内容没有单独的记录，不保存提纲片段
+    own = mem.document_id(content) == doc_id
+    try:
+        yield cache
+    except Exception:
+        # 中途失败（如重试次数用完）时保存已完成的片段，再次生成时只请求剩下的部分
+        if own and cache.parts:
+            mem.set_outline(doc_id, {**cache.old, **cache.parts})
+        raise
+    if own and cache.parts:
+        mem.set_outline(doc_id, cache.parts)
+
+
+def make_outline(blocks, mem, agent, mode='auto', context_tokens=2000):
+    """为已导入记忆的文档生成提纲；文档修改后再次生成时，只重新生成内容变化的部分"""
+    content = blocks_to_text(blocks)
+    with _stored_outline(mem, content) as cache:
+        return agent.outline(blocks, mem.get_context(content, context_tokens), mode, cache)
+
+
+async def amake_outline(blocks, mem, agent, mode='auto', context_tokens=2000):
+    # make_outline 的异步版本
+    content = blocks_to_text(blocks)
+    with _stored_outline(mem, content) as cache:
+        return await agent.aoutline(blocks, mem.get_context(content, context_tokens), mode, cache)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='加载文档并为学生生成全面学习提纲，并记忆知识领域'
     )
-    parser.add_argument('files', nargs='+', help='输入文件路径，支持 txt/docx/pptx')
+    parser.add_argument('files', nargs='*', help='输入文件路径，支持 txt/docx/pptx')
     parser.add_argument('--api_key', required=True, help='SiliconFlow API 密钥')
+    parser.add_argument('--base_url', default=governor.DEFAULT_URL,
+                        help='模型服务地址（OpenAI 兼容接口），离线测试时指向 fake_server.py')
+    parser.add_argument('--memory', default='memory.json', help='记忆文件路径，以 .db 结尾时使用 SQLite 存储')
+    parser.add_argument('--namespace', default=None, help='记忆命名空间（如用户名），不同命名空间的记忆互相独立')
+    parser.add_argument('--workers', type=int, default=None, help='解析文档的进程数，默认为 CPU 核数')
+    parser.add_argument('--cache_dir', default='.doc_cache', help='解析结果缓存目录')
+    parser.add_argument('--fast', action='store_true', help='直接流式解析 docx/pptx 的 XML，速度更快、内存更低')
+    parser.add_argument('--keep_boilerplate', action='store_true', help='保留幻灯片中重复的页脚、页码等内容')
+    parser.add_argument('--no_cache', action='store_true', help='不使用解析结果缓存')
+    parser.add_argument('--outline_mode', choices=['auto', 'fill', 'local', 'llm'], default='auto',
+                        help='提纲生成方式：auto/fill 利用文档自带的章节结构，local 不调用模型，llm 完全由模型生成')
+    parser.add_argument('--context_tokens', type=int, default=2000, help='每次请求附带的相关记忆上下文的 token 上限')
+    parser.add_argument('--chunk_tokens', type=int, default=6000, help='长文档分块生成提纲时每块的 token 上限')
+    parser.add_argument('--max_in_flight', type=int, default=4, help='同时进行的领域提取请求数上限')
+    parser.add_argument('--history', choices=LearningAgent.HISTORY_MODES, default='fresh',
+                        help='主 Agent 的对话记忆：fresh 每次请求新对话，window 保留最近的对话，full 保留全部对话')
+    parser.add_argument('--history_tokens', type=int, default=4000, help='history 为 window 时保留的对话 token 上限')
+    parser.add_argument('--rpm', type=int, default=1000, help='账号每分钟请求数限额')
+    parser.add_argument('--tpm', type=int, default=50000, help='账号每分钟 token 数限额')
+    parser.add_argument('--max_concurrency', type=int, default=8, help='同时进行的模型请求数上限，被限流时自动减小')
+    parser.add_argument('--usage_log', default='usage.jsonl',
+                        help='每次模型调用的 token 数、耗时和费用追加写入的 JSON Lines 文件，设为空字符串则不写')
+    parser.add_argument('--max_documents', type=int, default=None, help='记忆中最多保留的文档篇数，超出时淘汰最久未使用的')
+    parser.add_argument('--max_chars', type=int, default=None, help='记忆中文档正文的总字符数上限')
+    parser.add_argument('--ttl_days', type=float, default=None, help='文档超过该天数未被使用即从记忆中删除')
+    parser.add_argument('--forget', action='append', default=[], metavar='DOC_ID',
+                        help='从记忆中删除指定文档（可重复），只由它得到的知识领域一并删除')
     args = parser.parse_args()
+    if not args.files and not args.forget:
+        parser.error('需要输入文件或 --forget')
 
-    loader = DocumentLoader()
-    mem = MemoryStore()
-    agent = LearningAgent(api_key=args.api_key)
+    governor.configure(rpm=args.rpm, tpm=args.tpm, max_concurrency=args.max_concurrency)
+    loader = DocumentLoader(cache=None if args.no_cache else DocumentCache(args.cache_dir), fast=args.fast)
+    mem = open_memory(args.memory, args.namespace, max_documents=args.max_documents, max_chars=args.max_chars,
+                      ttl=args.ttl_days * 86400 if args.ttl_days is not None else None)
+    for doc_id in args.forget:
+        print(f"删除文档 {doc_id}: {'完成' if mem.forget(doc_id) else '不存在'}")
+    if not args.files:
+        sys.exit(0)
+    agent = LearningAgent(api_key=args.api_key, base_url=args.base_url, chunk_tokens=args.chunk_tokens, max_workers=args.max_in_flight,
+                          history=args.history, history_tokens=args.history_tokens)
 
-    # 逐个加载文档，记忆知识领域
-    for path in args.files:
-        print(f"加载文件: {path}")
-        text = loader.load(path)
-        mem.add_document(text)
-        # 提取并记忆该文档的知识领域
-        domains = agent.extract_domains(text, mem.get_context())
-        for d in domains:
-            mem.add_domain(d)
+    # 并行加载文档，记忆知识领域
+    docs = ingest(args.files, loader, mem, agent, args.workers, args.max_in_flight, not args.keep_boilerplate,
+                  args.context_tokens, args.outline_mode)
 
     # 使用最后一个文档生成提纲
-    content = mem.data['documents'][-1]
-    outline = agent.generate_outline(content, mem.get_context())
+    outline = make_outline(docs[-1], mem, agent, args.outline_mode, args.context_tokens)
     print("学生学习提纲:")
     print(outline)
+    print(f"模型调用统计: {accounting.LEDGER.summary()}")
+    if args.usage_log:
+        accounting.LEDGER.write(args.usage_log)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    """跨进程的建议性文件锁，同一进程内可重入
+
+    锁住 path 对应的锁文件（不存在时创建），其他进程在 acquire() 处等待；
+    同一进程的多个线程之间另用一把线程锁串行化。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.depth = 0
+        self._thread_lock = threading.RLock()
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if self.depth == 0:
+            try:
+                if not self._lock_file(blocking):
+                    self._thread_lock.release()
+                    return False
+            except BaseException:
+                self._thread_lock.release()
+                raise
+        self.depth += 1
+        return True
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            self._unlock_file()
+        self._thread_lock.release()
+
+    def _lock_file(self, blocking):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            else:
+                # msvcrt 的 LK_LOCK 只重试 10 秒，这里用非阻塞方式轮询
+                while True:
+                    try:
+                        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            raise
+                        time.sleep(0.05)
+        except OSError:
+            os.close(fd)
+            if blocking:
+                raise
+            return False
+        self._fd = fd
+        return True
+
+    def _unlock_file(self):
+        fd, self._fd = self._fd, None
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,1108 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import copy
+import json
+import time
+import zlib
+import atexit
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from chunking import estimate_tokens, split_chunks
+from retrieval import BM25Index, Postings, tokenize
+from domains import DomainMerger, domain_key, normalize_domain
+from dedup import LSHIndex, MinHasher, dump_signature, load_signature, shingles, similarity
+from locking import FileLock
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def default_title(text):
+    # 没有文件名时用第一行非空文本作标题
+    for line in text.split('\n'):
+        if line.strip():
+            return line.strip()[:40]
+    return ''
+
+
+def namespaced_path(path, namespace=None):
+    """每个用户或会话使用独立的记忆文件：memory.json + alice -> memory.alice.json"""
+    if not namespace:
+        return path
+    if not re.fullmatch(r'[\w.-]+', namespace):
+        raise ValueError(f'无效的记忆命名空间: {namespace!r}')
+    root, ext = os.path.splitext(path)
+    return f'{root}.{namespace}{ext}'
+
+
+def open_memory(path='memory.json', namespace=None, **limits):
+    """按扩展名选择记忆后端：.db/.sqlite 使用 SQLite，其余使用 JSON 快照 + 日志
+
+    给出 namespace 时打开该命名空间自己的记忆，互不影响。
+    limits 为淘汰策略 max_documents/max_chars/ttl，见 BaseMemoryStore.evict。
+    """
+    path = namespaced_path(path, namespace)
+    if os.path.splitext(path)[1].lower() in ('.db', '.sqlite', '.sqlite3'):
+        return SQLiteMemoryStore(path, **limits)
+    return MemoryStore(path, **limits)
+
+
+def _last_used(meta):
+    return meta.get('used') or meta['created']
+
+
+class BaseMemoryStore:
+    # 各后端共用的接口：domains()/documents()/list_documents()/questions()/canonical_domain()/
+    # get_document()/document_id()/find_document()/get_outline()/set_outline()/batch()/refresh()/forget()/touch()
+    # 以及 _insert_domain()/_insert_alias()/_link_domains() 由子类实现
+    # 读取只使用本进程的快照，refresh() 读入其他进程的修改；修改都在 _writing() 中进行
+    # 检索时文档按 chunk_tokens 切片建立 BM25 索引；各文档的倒排表在保存文档时生成并保存，
+    # 索引在第一次检索时由保存的倒排表构建
+    chunk_tokens = 300
+    # 知识领域字符 n-gram 相似度达到该值即视为同一领域
+    domain_threshold = 0.9
+    # 淘汰策略，None 表示不限制：文档篇数、正文总字符数、多少秒未被检索使用即过期
+    max_documents = None
+    max_chars = None
+    ttl = None
+    # 与已有文档的 MinHash 估计相似度达到该值即视为同一内容的不同格式（如 pptx 和导出的 docx），
+    # 不再单独保存，只记录为已有文档的副本
+    duplicate_threshold = 0.8
+    _hasher = MinHasher()
+    _index = None
+    _lsh = None
+    _merger = None
+
+    def questions(self):
+        return []
+
+    def has_document(self, text):
+        return self.document_id(text) is not None
+
+    def find_duplicate(self, text):
+        """返回与 text 相同或近似重复的已保存文档 id，没有时返回 None
+
+        候选只从 LSH 索引的同桶文档中取，不需要与全部文档比较。
+        """
+        doc_id = self.document_id(text)
+        if doc_id is None:
+            doc_id, _ = self._near_duplicate(text)
+        return doc_id
+
+    def _signature(self, text):
+        # text 的 MinHash 签名；没有可比较的内容（空白文本）时返回 None
+        sh = shingles(text)
+        return self._hasher.signature(sh) if sh else None
+
+    def _near_duplicate(self, text):
+        # 返回 (近似重复的文档 id 或 None, text 的签名)
+        index, signatures = self._duplicate_index()
+        sig = self._signature(text)
+        if sig is None:
+            return None, None
+        best, score = None, 0.0
+        for doc_id in index.query(sig):
+            s = similarity(sig, signatures[doc_id])
+            if s > score:
+                best, score = doc_id, s
+        return (best if score >= self.duplicate_threshold else None), sig
+
+    def _duplicate_index(self):
+        # 由保存文档时记下的签名构建，不读取正文
+        if self._lsh is None:
+            index, signatures = LSHIndex(), {}
+            for doc_id, sig in self._stored_signatures():
+                index.add(doc_id, sig)
+                signatures[doc_id] = sig
+            self._lsh = index, signatures
+        return self._lsh
+
+    def _reset_caches(self):
+        # 丢弃由记忆内容派生的检索索引、去重索引和领域词表，下次使用时重建
+        self._index = None
+        self._lsh = None
+        self._merger = None
+
+    def add_domain(self, domain):
+        self.add_domains([domain])
+
+    def add_domains(self, domains, doc_id=None):
+        """清理并归并一批知识领域，返回对应的规范名称列表
+
+        已记录的别名直接映射到规范名称；与已有领域只差标点、大小写或通用后缀的（如“量子计算基础”“量子计算。”）
+        记为别名；字面上高度相似的归并到已有领域，但不记为别名；其余作为新领域加入。别名表随记忆一起保存。
+        给出 doc_id 时，把这些领域记录到该文档的元数据中。
+        """
+        with self._writing():
+            return self._add_domains(domains, doc_id)
+
+    def _add_domains(self, domains, doc_id):
+        merger = self._domain_merger()
+        names = []
+        fresh = []
+        for d in domains:
+            d = normalize_domain(d)
+            if not d:
+                continue
+            canonical = d if d in merger else self.canonical_domain(d)
+            if canonical is not None and domain_key(canonical) != domain_key(d):
+                # 早期版本按相似度记下的别名可能把不同的概念（如“定积分”“不定积分”）归在一起，不再采用
+                canonical = None
+            if canonical is None:
+                fresh.append(d)
+            else:
+                names.append(canonical)
+        for name, canonical, exact in merger.merge(fresh):
+            if canonical is None:
+                self._insert_domain(name)
+                names.append(name)
+            else:
+                if exact:
+                    self._insert_alias(name, canonical)
+                names.append(canonical)
+        names = list(dict.fromkeys(names))
+        if doc_id is not None and names:
+            self._link_domains(doc_id, names)
+        return names
+
+    def _set_limits(self, max_documents=None, max_chars=None, ttl=None):
+        self.max_documents = max_documents
+        self.max_chars = max_chars
+        self.ttl = ttl
+
+    def evict(self, keep=(), now=None):
+        """按淘汰策略删除文档，返回被删除的文档 id
+
+        先删除超过 ttl 未被使用的文档，再按最近一次被检索使用的时间（从未使用过的按保存时间）
+        从旧到新删除，直到篇数和总字符数都不超过上限。keep 中的文档不会被删除。
+        """
+        now = time.time() if now is None else now
+        removed = []
+        with self._writing():
+            docs = sorted(self.list_documents(), key=_last_used)
+            count = len(docs)
+            total = sum(d['size'] for d in docs)
+            for d in docs:
+                expired = self.ttl is not None and now - _last_used(d) > self.ttl
+                over = ((self.max_documents is not None and count > self.max_documents)
+                        or (self.max_chars is not None and total > self.max_chars))
+                if not (expired or over):
+                    # 按时间排序，之后的文档都不会过期
+                    break
+                if d['id'] in keep:
+                    continue
+                self.forget(d['id'])
+                removed.append(d['id'])
+                count -= 1
+                total -= d['size']
+        return removed
+
+    def _enforce_limits(self, doc_id):
+        # 保存新文档后调用
+        if self.max_documents is not None or self.max_chars is not None or self.ttl is not None:
+            self.evict(keep=(doc_id,))
+
+    def _domain_merger(self):
+        if self._merger is None:
+            self._merger = DomainMerger(self.domains(), self.domain_threshold)
+        return self._merger
+
+    def get_context(self, query=None, token_budget=2000, exclude=()):
+        """生成提示词中的记忆上下文
+
+        不给 query 时返回全部记忆；给出 query（通常是当前文档）时，只返回与之最相关的
+        知识领域和文档片段，总量不超过 token_budget，提示词长度不再随记忆增长。
+        exclude 中的文档（如当前文档的旧版本）不作为片段返回。
+        """
+        self.refresh(blocking=False)
+        if query is None:
+            return self._full_context()
+        query_terms = set(tokenize(query))
+        used = 0
+
+        # 知识领域：按与当前文档的词重合比例排序，最多占四分之一预算
+        scored = []
+        for d in self.domains():
+            terms = set(tokenize(d))
+            if terms:
+                overlap = len(terms & query_terms) / len(terms)
+                if overlap >= 0.5:
+                    scored.append((overlap, d))
+        scored.sort(key=lambda x: x[0], reverse=True)
+        domains = []
+        for _, d in scored:
+            n = estimate_tokens(d) + 1
+            if used + n > token_budget // 4:
+                break
+            domains.append(d)
+            used += n
+
+        # 文档片段：BM25 排序，跳过当前文档自身
+        skip = {content_hash(query), self.document_id(query), *exclude}
+        chunks = []
+        bodies = {}
+        hits = set()
+        for (h, i), _ in self._retrieval_index().search(query, k=50, exclude=lambda key: key[0] in skip):
+            if h not in bodies:
+                bodies[h] = split_chunks(self.get_document(h) or '', self.chunk_tokens, 0)
+            if i >= len(bodies[h]):
+                continue
+            chunk = bodies[h][i]
+            n = estimate_tokens(chunk) + 1
+            if used + n > token_budget:
+                continue
+            chunks.append(chunk)
+            hits.add(h)
+            used += n
+        # 记录文档最近一次被使用的时间，供 LRU 淘汰
+        if hits:
+            self.touch(hits)
+
+        domains = '\n'.join(domains)
+        docs = '\n……\n'.join(chunks)
+        return (
+            f'已了解知识领域：\n{domains}\n'
+            f'已提交文档（相关片段）：\n{docs}\n'
+        )
+
+    def _retrieval_index(self):
+        # 由保存文档时记下的倒排表构建，不读取正文
+        if self._index is None:
+            self._index = BM25Index()
+            for doc_id, postings in self._stored_postings():
+                self._index.add(doc_id, postings)
+        return self._index
+
+    def _postings(self, text):
+        return Postings.from_texts(split_chunks(text, self.chunk_tokens, 0))
+
+    def _index_document(self, h, sig, postings):
+        # 索引尚未构建时无需维护，构建时会读取保存的倒排表（检索索引）或签名（去重索引）
+        if self._index is not None:
+            self._index.add(h, postings)
+        if self._lsh is not None and sig is not None:
+            index, signatures = self._lsh
+            index.add(h, sig)
+            signatures[h] = sig
+
+    def _unindex_document(self, doc_id):
+        if self._index is not None:
+            self._index.remove(doc_id)
+        if self._lsh is not None:
+            index, signatures = self._lsh
+            sig = signatures.pop(doc_id, None)
+            if sig is not None:
+                index.remove(doc_id, sig)
+
+    def _full_context(self):
+        # 将 domains, documents 一并作为上下文
+        domains = '\n'.join(self.domains())
+        docs = '\n'.join(self.documents())
+        context = (
+            f'已了解知识领域：\n{domains}\n'
+            f'已提交文档：\n{docs}\n'
+        )
+        qs = self.questions()
+        if qs:
+            context += '已提问问题：\n' + '\n'.join(qs)
+        return context
+
+
+class MemoryStore(BaseMemoryStore):
+    """Agent 记忆
+
+    memory.json 是快照，每次修改只在 memory.json.journal 末尾追加一行 JSON，
+    日志累计到 compact_every 条时合并进快照。快照先写临时文件再原子替换，
+    日志行带递增序号，重放时跳过快照中已包含的部分，因此任何时刻崩溃都不会损坏记忆。
+
+    多个进程可以共用同一份记忆：每次修改前取得 memory.json.lock 上的文件锁，
+    先读入其他进程追加的日志（快照被合并过时重新加载），再追加自己的日志。
+    读取不加锁，只使用本进程内存中的快照。
+
+    快照和日志中只保存文档的元数据（哈希、标题、大小、知识领域、MinHash 签名），正文压缩后单独存放在
+    memory_blobs 目录，需要时才读取，启动时间和内存占用不随历史文档增长；检索用的倒排表也存放在该目录。
+    """
+
+    def __init__(self, path='memory.json', fsync_every=32, fsync_interval=1.0, compact_every=1000,
+                 max_documents=None, max_chars=None, ttl=None):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.blob_dir = os.path.splitext(path)[0] + '_blobs'
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self._lock = FileLock(path + '.lock')
+        # batch() 中缓存的日志行、新写入的正文文件和待删除的正文文件
+        self._batch = None
+        self._batch_blobs = None
+        self._batch_drop = None
+        self._set_limits(max_documents, max_chars, ttl)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._sync_timer = None
+        with self._lock:
+            migrated = self._load()
+            self._journal = open(self.journal_path, 'ab')
+            if migrated or not os.path.exists(path):
+                self.compact()
+        atexit.register(self.close)
+
+    def _load(self):
+        # 读取快照并重放其后的日志；返回是否需要把旧格式的记忆写成新快照
+        self.data = {'domains': [], 'documents': [], 'questions': [], 'aliases': {}}
+        self.seq = 0
+        self._snapshot_id = self._snapshot_stat()
+        if self._snapshot_id is not None:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+            self.seq = self.data.pop('seq', 0)
+            # 确保所有字段存在
+            self.data.setdefault('domains', [])
+            self.data.setdefault('documents', [])
+            self.data.setdefault('questions', [])
+            # 知识领域别名 -> 规范名称
+            self.data.setdefault('aliases', {})
+        # 旧版本的记忆直接保存文档正文，转换为元数据 + 正文文件
+        migrated = any(isinstance(d, str) for d in self.data['documents'])
+        self.data['documents'] = [self._to_meta(d) for d in self.data['documents']]
+        self._reindex()
+        self._reset_caches()
+        self._journal_pos = 0
+        self._journal_len = self._replay()
+        # 早期版本的元数据中没有 MinHash 签名，读取正文补上，写入新快照后启动时不再读取正文
+        for meta in self.data['documents']:
+            if 'minhash' not in meta:
+                text = self.get_document(meta['id'])
+                sig = self._signature(text) if text is not None else None
+                meta['minhash'] = dump_signature(sig) if sig is not None else None
+                migrated = True
+        return migrated
+
+    def _snapshot_stat(self):
+        # 快照总是整体替换，文件标识变化说明其他进程合并过日志
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def refresh(self, blocking=True):
+        """读入其他进程写入的修改；blocking=False 时若锁被占用则跳过"""
+        if self._lock.acquire(blocking):
+            try:
+                self._catch_up()
+            finally:
+                self._lock.release()
+
+    def _catch_up(self):
+        # 只在持有文件锁时调用
+        if self._snapshot_stat() != self._snapshot_id:
+            self._load()
+            return
+        n = self._replay()
+        if n:
+            self._journal_len += n
+            self._reset_caches()
+
+    def domains(self):
+        return self.data['domains']
+
+    def documents(self):
+        # 逐篇读取正文；其他进程清空记忆时正文可能已被删除
+        for meta in self.data['documents']:
+            text = self.get_document(meta['id'])
+            if text is not None:
+                yield text
+
+    def list_documents(self):
+        return self.data['documents']
+
+    def _stored_signatures(self):
+        for meta in self.data['documents']:
+            if meta.get('minhash'):
+                yield meta['id'], load_signature(meta['minhash'])
+
+    def _stored_postings(self):
+        for meta in self.data['documents']:
+            path = self._blob_path(meta['id'], '.bm25.z')
+            try:
+                with open(path, 'rb') as f:
+                    postings = Postings.load(f.read())
+            except FileNotFoundError:
+                # 早期版本没有保存倒排表，读取正文生成一次；其他进程清空记忆时正文可能已被删除
+                text = self.get_document(meta['id'])
+                if text is None:
+                    continue
+                postings = self._postings(text)
+                self._atomic_write(path, postings.dump())
+            yield meta['id'], postings
+
+    def get_document(self, doc_id):
+        try:
+            with open(self._blob_path(doc_id), 'rb') as f:
+                return zlib.decompress(f.read()).decode('utf-8')
+        except FileNotFoundError:
+            return None
+
+    def questions(self):
+        return self.data['questions']
+
+    def document_id(self, text):
+        """text 已保存（或作为副本链接到已保存的文档）时返回文档 id，否则返回 None"""
+        h = content_hash(text)
+        if h in self._docs:
+            return h
+        return self._duplicates.get(h)
+
+    def canonical_domain(self, name):
+        return self.data['aliases'].get(name)
+
+    def _insert_domain(self, domain):
+        if domain not in self._domain_set:
+            self._log('add_domain', domain)
+
+    def _insert_alias(self, alias, canonical):
+        self._log('add_alias', [alias, canonical])
+
+    def _link_domains(self, doc_id, names):
+        if doc_id in self._docs:
+            self._log('link_domains', [doc_id, names])
+
+    def find_document(self, title):
+        """按标题查找最近保存的文档，返回元数据或 None"""
+        for meta in reversed(self.data['documents']):
+            if meta['title'] == title:
+                return meta
+        return None
+
+    def add_document(self, text, title=None, units=None):
+        """保存文档，返回文档 id（内容哈希）；重复的文档不会再次保存
+
+        units 为文档各段落或幻灯片的内容哈希，再次导入修改过的文档时用来比较差异。
+        """
+        if not text:
+            return None
+        h = content_hash(text)
+        with self._writing():
+            if h in self._docs:
+                return h
+            dup, sig = self._near_duplicate(text)
+            if dup is not None:
+                # 近似重复：不保存正文，只在已有文档上记录这份副本
+                self._log('link_duplicate', [h, dup, title or default_title(text)])
+                return dup
+            # 先写正文和倒排表再记日志，日志中出现的文档一定有正文
+            postings = self._postings(text)
+            self._write_blob(h, text)
+            self._atomic_write(self._blob_path(h, '.bm25.z'), postings.dump())
+            meta = self._meta(h, text, title, sig)
+            if units is not None:
+                meta['units'] = list(units)
+            self._log('add_document', meta)
+            self._index_document(h, sig, postings)
+            self._enforce_limits(h)
+        return h
+
+    def forget(self, doc_id):
+        """删除一篇文档及只由它得到的知识领域，返回是否删除"""
+        with self._writing():
+            if doc_id not in self._docs:
+                return False
+            self._log('forget', doc_id)
+            self._unindex_document(doc_id)
+            if self._batch_drop is not None:
+                # 事务提交后才删除正文，回滚时文档还在
+                self._batch_drop.append(doc_id)
+            else:
+                self._remove_blob(doc_id)
+        return True
+
+    def touch(self, doc_ids, now=None):
+        """记录文档最近一次被使用的时间"""
+        doc_ids = [h for h in doc_ids if h in self._docs]
+        if doc_ids:
+            with self._writing():
+                self._log('touch', [doc_ids, time.time() if now is None else now])
+
+    def _meta(self, h, text, title=None, sig=None):
+        # minhash 为去重用的签名，启动后由它构建 LSH 索引，不需要读取正文
+        return {'id': h, 'title': title or default_title(text), 'size': len(text),
+                'domains': [], 'created': time.time(),
+                'minhash': dump_signature(sig) if sig is not None else None}
+
+    def _to_meta(self, doc):
+        if isinstance(doc, str):
+            h = content_hash(doc)
+            self._write_blob(h, doc)
+            return self._meta(h, doc, sig=self._signature(doc))
+        return doc
+
+    def get_outline(self, doc_id):
+        """返回文档已生成的提纲片段 {片段哈希: 提纲文本}，没有时返回空字典"""
+        try:
+            with open(self._blob_path(doc_id, '.outline.z'), 'rb') as f:
+                return json.loads(zlib.decompress(f.read()).decode('utf-8'))
+        except FileNotFoundError:
+            return {}
+
+    def set_outline(self, doc_id, parts):
+        # 片段以内容哈希为键，不会过时，因此不需要记日志，也不参与事务回滚
+        self._atomic_write(self._blob_path(doc_id, '.outline.z'),
+                           zlib.compress(json.dumps(parts, ensure_ascii=False).encode('utf-8')))
+
+    def _blob_path(self, doc_id, suffix='.txt.z'):
+        return os.path.join(self.blob_dir, doc_id + suffix)
+
+    def _write_blob(self, doc_id, text):
+        path = self._blob_path(doc_id)
+        if self._batch_drop and doc_id in self._batch_drop:
+            # 同一事务中先删除又重新保存
+            self._batch_drop.remove(doc_id)
+        if os.path.exists(path):
+            return
+        if self._batch_blobs is not None:
+            self._batch_blobs.append(doc_id)
+        self._atomic_write(path, zlib.compress(text.encode('utf-8')))
+
+    def _atomic_write(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=self.blob_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _remove_blob(self, doc_id):
+        for suffix in ('.txt.z', '.bm25.z', '.outline.z'):
+            try:
+                os.remove(self._blob_path(doc_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def add_question(self, q):
+        if q:
+            with self._writing():
+                self._log('add_question', q)
+
+    def clear(self):
+        with self._lock:
+            self.data = {'domains': [], 'documents': [], 'questions': [], 'aliases': {}}
+            self._reindex()
+            self._reset_caches()
+            self.compact()
+            for name in os.listdir(self.blob_dir):
+                try:
+                    os.remove(os.path.join(self.blob_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def _reindex(self):
+        # 用集合做查重，避免线性扫描和整篇文档比较
+        self._domain_set = set(self.data['domains'])
+        self._docs = {meta['id']: meta for meta in self.data['documents']}
+        # 副本的内容哈希 -> 保存的文档 id
+        self._duplicates = {d['id']: meta['id'] for meta in self.data['documents'] for d in meta.get('duplicates', ())}
+
+    def _apply(self, op, value):
+        if op == 'add_domain':
+            self.data['domains'].append(value)
+            self._domain_set.add(value)
+        elif op == 'add_document':
+            meta = self._to_meta(value)
+            self.data['documents'].append(meta)
+            self._docs[meta['id']] = meta
+        elif op == 'link_domains':
+            doc_id, names = value
+            meta = self._docs.get(doc_id)
+            if meta is not None:
+                meta['domains'] = list(dict.fromkeys(meta['domains'] + names))
+        elif op == 'add_question':
+            self.data['questions'].append(value)
+        elif op == 'add_alias':
+            alias, canonical = value
+            self.data['aliases'][alias] = canonical
+        elif op == 'touch':
+            doc_ids, now = value
+            for h in doc_ids:
+                meta = self._docs.get(h)
+                if meta is not None:
+                    meta['used'] = now
+        elif op == 'link_duplicate':
+            h, doc_id, title = value
+            meta = self._docs.get(doc_id)
+            if meta is not None:
+                meta.setdefault('duplicates', []).append({'id': h, 'title': title})
+                self._duplicates[h] = doc_id
+        elif op == 'forget':
+            meta = self._docs.pop(value, None)
+            if meta is None:
+                return
+            self.data['documents'].remove(meta)
+            for d in meta.get('duplicates', ()):
+                self._duplicates.pop(d['id'], None)
+            # 其他文档仍在使用的领域保留；没有关联任何文档的领域（早期版本记录的）也保留
+            orphans = set(meta['domains']).difference(*(m['domains'] for m in self._docs.values()))
+            if orphans:
+                self.data['domains'] = [d for d in self.data['domains'] if d not in orphans]
+                self._domain_set -= orphans
+                self.data['aliases'] = {a: c for a, c in self.data['aliases'].items() if c not in orphans}
+                self._merger = None
+
+    def _replay(self):
+        # 从上次读到的位置继续重放日志，返回新读到的条数；只在持有文件锁时调用
+        if not os.path.exists(self.journal_path):
+            return 0
+        n = 0
+        good = self._journal_pos
+        with open(self.journal_path, 'rb+') as f:
+            f.seek(good)
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # 写日志的进程中途崩溃，残行之后的日志会接在残行后面，截掉它；
+                    # 持有锁时不会有其他进程正在写
+                    f.truncate(good)
+                    break
+                good += len(line)
+                n += 1
+                if entry['seq'] > self.seq:
+                    self._apply(entry['op'], entry['value'])
+                    self.seq = entry['seq']
+        self._journal_pos = good
+        return n
+
+    @contextmanager
+    def _writing(self):
+        # 持有文件锁，并在最外层先读入其他进程的修改，保证序号连续、查重准确
+        with self._lock:
+            if self._lock.depth == 1:
+                self._catch_up()
+            yield
+
+    @contextmanager
+    def batch(self):
+        """事务：块内的修改先缓存，正常退出时一次性写入日志；出现异常则全部回滚
+
+        with mem.batch():
+            doc_id = mem.add_document(text)
+            mem.add_domains(domains, doc_id)
+        """
+        if self._batch is not None:
+            # 嵌套时并入外层事务
+            yield self
+            return
+        # 整个事务期间持有文件锁，其他进程的修改不会插在中间
+        with self._writing():
+            saved = copy.deepcopy(self.data), self.seq
+            self._batch, self._batch_blobs, self._batch_drop = [], [], []
+            try:
+                yield self
+            except BaseException:
+                blobs = self._batch_blobs
+                self._batch = self._batch_blobs = self._batch_drop = None
+                self.data, self.seq = saved
+                self._reindex()
+                self._reset_caches()
+                for doc_id in blobs:
+                    self._remove_blob(doc_id)
+                raise
+            lines, drop = self._batch, self._batch_drop
+            self._batch = self._batch_blobs = self._batch_drop = None
+            if lines:
+                self._write_lines(lines)
+                self.sync()
+            for doc_id in drop:
+                self._remove_blob(doc_id)
+
+    def _log(self, op, value):
+        self._apply(op, value)
+        self.seq += 1
+        line = json.dumps({'seq': self.seq, 'op': op, 'value': value}, ensure_ascii=False) + '\n'
+        if self._batch is not None:
+            self._batch.append(line)
+            return
+        self._write_lines([line])
+
+    def _write_lines(self, lines):
+        self._journal.write(''.join(lines).encode('utf-8'))
+        self._journal.flush()
+        self._journal_pos = self._journal.tell()
+        self._unsynced += len(lines)
+        self._journal_len += len(lines)
+        if self._journal_len >= self.compact_every:
+            self.compact()
+        elif self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+        if self._unsynced:
+            self._schedule_sync()
+
+    def _schedule_sync(self):
+        # 一批写入结束后不一定还有下一次写入，剩下的日志由定时器在 fsync_interval 秒后落盘
+        if self._sync_timer is None:
+            self._sync_timer = threading.Timer(self.fsync_interval, self._sync_idle)
+            self._sync_timer.daemon = True
+            self._sync_timer.start()
+
+    def _sync_idle(self):
+        with self._lock:
+            self._sync_timer = None
+            if not self._journal.closed:
+                self.sync()
+
+    def sync(self):
+        # 批量 fsync：不是每条日志都落盘，崩溃时最多丢失最近 fsync_every 条或 fsync_interval 秒内的修改
+        if self._unsynced:
+            os.fsync(self._journal.fileno())
+            self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def compact(self):
+        """把当前记忆写成新快照，并清空日志"""
+        with self._writing():
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(dict(self.data, seq=self.seq), f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self._snapshot_id = self._snapshot_stat()
+            # 快照已包含全部日志，此时截断日志；即使截断前崩溃，重放也会按序号跳过
+            self._journal.seek(0)
+            self._journal.truncate()
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._unsynced = 0
+            self._journal_len = 0
+            self._journal_pos = 0
+            self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._sync_timer is not None:
+                self._sync_timer.cancel()
+                self._sync_timer = None
+            if not self._journal.closed:
+                self.sync()
+                self._journal.close()
+
+
+class SQLiteMemoryStore(BaseMemoryStore):
+    """SQLite 记忆后端
+
+    文档以内容哈希为主键去重，知识领域在唯一索引上去重，问题带时间戳，
+    查重和查找都走索引，不需要把整个记忆读入内存。
+    多个进程可以同时打开同一个数据库：WAL 模式下读取互不阻塞，batch() 用 BEGIN IMMEDIATE 取得写锁。
+    """
+
+    def __init__(self, path='memory.db', max_documents=None, max_chars=None, ttl=None):
+        self.path = path
+        self._set_limits(max_documents, max_chars, ttl)
+        # GUI 主线程和后台线程会共用同一个连接，用锁串行化；batch() 期间一直持有该锁
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        # 其他进程持有写锁时最多等待 timeout 秒
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INTEGER PRIMARY KEY,
+                    hash TEXT NOT NULL UNIQUE,
+                    body TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    title TEXT NOT NULL DEFAULT '',
+                    size INTEGER NOT NULL DEFAULT 0,
+                    used REAL NOT NULL DEFAULT 0,
+                    units TEXT,
+                    outline TEXT
+                );
+                CREATE TABLE IF NOT EXISTS document_domains (
+                    hash TEXT NOT NULL,
+                    domain TEXT NOT NULL,
+                    PRIMARY KEY (hash, domain)
+                );
+                CREATE TABLE IF NOT EXISTS duplicates (
+                    hash TEXT PRIMARY KEY,
+                    doc TEXT NOT NULL,
+                    title TEXT NOT NULL DEFAULT ''
+                );
+                CREATE INDEX IF NOT EXISTS duplicates_doc ON duplicates (doc);
+                CREATE TABLE IF NOT EXISTS document_index (
+                    hash TEXT PRIMARY KEY,
+                    minhash TEXT,
+                    postings BLOB
+                );
+                CREATE TABLE IF NOT EXISTS domains (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL UNIQUE
+                );
+                CREATE TABLE IF NOT EXISTS aliases (
+                    alias TEXT PRIMARY KEY,
+                    canonical TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS questions (
+                    id INTEGER PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    created REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS questions_created ON questions (created);
+                """
+            )
+            # 早期版本的 documents 表没有 title/size/used/units/outline 列
+            columns = {row[1] for row in self.conn.execute('PRAGMA table_info(documents)')}
+            if 'title' not in columns:
+                self.conn.execute("ALTER TABLE documents ADD COLUMN title TEXT NOT NULL DEFAULT ''")
+            if 'size' not in columns:
+                self.conn.execute('ALTER TABLE documents ADD COLUMN size INTEGER NOT NULL DEFAULT 0')
+            if 'used' not in columns:
+                self.conn.execute('ALTER TABLE documents ADD COLUMN used REAL NOT NULL DEFAULT 0')
+            for name in ('units', 'outline'):
+                if name not in columns:
+                    self.conn.execute(f'ALTER TABLE documents ADD COLUMN {name} TEXT')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS documents_title ON documents (title)')
+            if 'postings' not in {row[1] for row in self.conn.execute('PRAGMA table_info(document_index)')}:
+                self.conn.execute('ALTER TABLE document_index ADD COLUMN postings BLOB')
+            # 早期版本没有保存 MinHash 签名和倒排表，读取正文补上一次，以后构建索引时不再读取正文
+            missing = self.conn.execute(
+                'SELECT hash, body FROM documents '
+                'WHERE hash NOT IN (SELECT hash FROM document_index WHERE postings IS NOT NULL)').fetchall()
+            for h, body in missing:
+                self._save_index(h, self._signature(body), self._postings(body))
+        self._data_version = self._query('PRAGMA data_version')[0]
+        atexit.register(self.close)
+
+    def refresh(self, blocking=True):
+        """其他连接提交过修改时丢弃本进程缓存的检索索引和领域词表；blocking=False 时若锁被占用则跳过"""
+        if not self._lock.acquire(blocking):
+            return
+        try:
+            version = self._query('PRAGMA data_version')[0]
+            if version != self._data_version:
+                self._data_version = version
+                self._reset_caches()
+        finally:
+            self._lock.release()
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return [row[0] for row in self.conn.execute(sql, args)]
+
+    def domains(self):
+        return self._query('SELECT name FROM domains ORDER BY id')
+
+    def documents(self):
+        # 逐篇读取正文
+        for h in self._query('SELECT hash FROM documents ORDER BY id'):
+            text = self.get_document(h)
+            if text is not None:
+                yield text
+
+    def list_documents(self):
+        with self._lock:
+            rows = self.conn.execute('SELECT hash, title, size, created, used FROM documents ORDER BY id').fetchall()
+            links = self.conn.execute('SELECT hash, domain FROM document_domains').fetchall()
+            copies = self.conn.execute('SELECT hash, doc, title FROM duplicates').fetchall()
+        domains = {}
+        for h, d in links:
+            domains.setdefault(h, []).append(d)
+        duplicates = {}
+        for h, doc, title in copies:
+            duplicates.setdefault(doc, []).append({'id': h, 'title': title})
+        docs = []
+        for h, title, size, created, used in rows:
+            meta = {'id': h, 'title': title, 'size': size, 'domains': domains.get(h, []), 'created': created,
+                    'used': used}
+            if h in duplicates:
+                meta['duplicates'] = duplicates[h]
+            docs.append(meta)
+        return docs
+
+    def _stored_signatures(self):
+        with self._lock:
+            rows = self.conn.execute('SELECT hash, minhash FROM document_index WHERE minhash IS NOT NULL').fetchall()
+        return [(h, load_signature(sig)) for h, sig in rows]
+
+    def _stored_postings(self):
+        with self._lock:
+            rows = self.conn.execute('SELECT hash, postings FROM document_index WHERE postings IS NOT NULL').fetchall()
+        return [(h, Postings.load(data)) for h, data in rows]
+
+    def _save_index(self, doc_id, sig, postings):
+        # 去重索引所需的签名和检索用的倒排表单独存一张表，读取时不经过正文所在的行
+        self.conn.execute('INSERT OR REPLACE INTO document_index (hash, minhash, postings) VALUES (?, ?, ?)',
+                          (doc_id, dump_signature(sig) if sig is not None else None, postings.dump()))
+
+    def get_document(self, doc_id):
+        rows = self._query('SELECT body FROM documents WHERE hash = ?', (doc_id,))
+        return rows[0] if rows else None
+
+    def questions(self):
+        return self._query('SELECT text FROM questions ORDER BY created, id')
+
+    def document_id(self, text):
+        """text 已保存（或作为副本链接到已保存的文档）时返回文档 id，否则返回 None"""
+        h = content_hash(text)
+        if self._query('SELECT 1 FROM documents WHERE hash = ?', (h,)):
+            return h
+        rows = self._query('SELECT doc FROM duplicates WHERE hash = ?', (h,))
+        return rows[0] if rows else None
+
+    def canonical_domain(self, name):
+        rows = self._query('SELECT canonical FROM aliases WHERE alias = ?', (name,))
+        return rows[0] if rows else None
+
+    def _insert_domain(self, domain):
+        self._execute('INSERT OR IGNORE INTO domains (name) VALUES (?)', (domain,))
+
+    def _insert_alias(self, alias, canonical):
+        self._execute('INSERT OR REPLACE INTO aliases (alias, canonical) VALUES (?, ?)', (alias, canonical))
+
+    def _link_domains(self, doc_id, names):
+        with self._transaction():
+            self.conn.executemany('INSERT OR IGNORE INTO document_domains (hash, domain) VALUES (?, ?)',
+                                  [(doc_id, n) for n in names])
+
+    def find_document(self, title):
+        """按标题查找最近保存的文档，返回元数据或 None"""
+        with self._lock:
+            row = self.conn.execute('SELECT hash, title, size, created, used, units FROM documents '
+                                    'WHERE title = ? ORDER BY id DESC LIMIT 1', (title,)).fetchone()
+            if row is None:
+                return None
+            h, title, size, created, used, units = row
+            domains = [r[0] for r in self.conn.execute('SELECT domain FROM document_domains WHERE hash = ?', (h,))]
+        meta = {'id': h, 'title': title, 'size': size, 'domains': domains, 'created': created, 'used': used}
+        if units is not None:
+            meta['units'] = units.split()
+        return meta
+
+    def get_outline(self, doc_id):
+        """返回文档已生成的提纲片段 {片段哈希: 提纲文本}，没有时返回空字典"""
+        rows = self._query('SELECT outline FROM documents WHERE hash = ?', (doc_id,))
+        return json.loads(rows[0]) if rows and rows[0] else {}
+
+    def set_outline(self, doc_id, parts):
+        self._execute('UPDATE documents SET outline = ? WHERE hash = ?',
+                      (json.dumps(parts, ensure_ascii=False), doc_id))
+
+    def add_document(self, text, title=None, units=None):
+        """保存文档，返回文档 id（内容哈希）；重复的文档不会再次保存
+
+        units 为文档各段落或幻灯片的内容哈希，再次导入修改过的文档时用来比较差异。
+        """
+        if not text:
+            return None
+        h = content_hash(text)
+        with self.batch():
+            if self._query('SELECT 1 FROM documents WHERE hash = ?', (h,)):
+                return h
+            dup, sig = self._near_duplicate(text)
+            if dup is not None:
+                # 近似重复：不保存正文，只在已有文档上记录这份副本
+                self._execute('INSERT OR REPLACE INTO duplicates (hash, doc, title) VALUES (?, ?, ?)',
+                              (h, dup, title or default_title(text)))
+                return dup
+            self._execute('INSERT INTO documents (hash, body, created, title, size, units) VALUES (?, ?, ?, ?, ?, ?)',
+                          (h, text, time.time(), title or default_title(text), len(text),
+                           ' '.join(units) if units is not None else None))
+            postings = self._postings(text)
+            self._save_index(h, sig, postings)
+            self._index_document(h, sig, postings)
+            self._enforce_limits(h)
+        return h
+
+    def forget(self, doc_id):
+        """删除一篇文档及只由它得到的知识领域，返回是否删除"""
+        with self.batch():
+            # 其他文档仍在使用的领域保留；没有关联任何文档的领域（早期版本记录的）也保留
+            orphans = self._query(
+                'SELECT domain FROM document_domains WHERE hash = ? AND domain NOT IN '
+                '(SELECT domain FROM document_domains WHERE hash != ?)', (doc_id, doc_id))
+            if not self._execute('DELETE FROM documents WHERE hash = ?', (doc_id,)):
+                return False
+            self._execute('DELETE FROM document_domains WHERE hash = ?', (doc_id,))
+            self._execute('DELETE FROM duplicates WHERE doc = ?', (doc_id,))
+            self._execute('DELETE FROM document_index WHERE hash = ?', (doc_id,))
+            if orphans:
+                self.conn.executemany('DELETE FROM domains WHERE name = ?', [(d,) for d in orphans])
+                self.conn.executemany('DELETE FROM aliases WHERE canonical = ?', [(d,) for d in orphans])
+                self._merger = None
+        self._unindex_document(doc_id)
+        return True
+
+    def touch(self, doc_ids, now=None):
+        """记录文档最近一次被使用的时间"""
+        now = time.time() if now is None else now
+        with self._transaction():
+            self.conn.executemany('UPDATE documents SET used = ? WHERE hash = ?', [(now, h) for h in doc_ids])
+
+    def add_question(self, q):
+        if q:
+            self._execute('INSERT INTO questions (text, created) VALUES (?, ?)', (q, time.time()))
+
+    def clear(self):
+        with self._transaction():
+            self.conn.execute('DELETE FROM documents')
+            self.conn.execute('DELETE FROM domains')
+            self.conn.execute('DELETE FROM questions')
+            self.conn.execute('DELETE FROM aliases')
+            self.conn.execute('DELETE FROM document_domains')
+            self.conn.execute('DELETE FROM duplicates')
+            self.conn.execute('DELETE FROM document_index')
+        self._reset_caches()
+
+    def _execute(self, sql, args=()):
+        # 返回受影响的行数
+        with self._transaction():
+            return self.conn.execute(sql, args).rowcount
+
+    @contextmanager
+    def _transaction(self):
+        # batch() 之外每条语句单独提交；batch() 之内由 batch() 统一提交
+        with self._lock:
+            if self._batch_depth:
+                yield
+            else:
+                with self.conn:
+                    yield
+
+    @contextmanager
+    def batch(self):
+        """事务：块内的修改在退出时一次提交，出现异常则全部回滚"""
+        with self._lock:
+            if not self._batch_depth:
+                self.refresh()
+                # 立即取得写锁，事务中先读后写的查重不会与其他进程交错
+                self.conn.execute('BEGIN IMMEDIATE')
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                if self._batch_depth == 1:
+                    self.conn.rollback()
+                    self._reset_caches()
+                raise
+            else:
+                if self._batch_depth == 1:
+                    self.conn.commit()
+            finally:
+                self._batch_depth -= 1
+
+    def _writing(self):
+        return self.batch()
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""docx/pptx 快速文本提取
+
+直接从 zip 包中流式解析 word/document.xml 和 ppt/slides/slideN.xml，
+不构建 python-docx / python-pptx 的对象模型。产出的 (slide, paragraph, heading, text)
+元组与 learning_assistant.DocumentLoader 的 Block 字段一一对应。
+
+命令行运行 `python ooxml.py 文件...` 可与 python-docx / python-pptx 的解析结果做一致性比对，不给文件时比对内置的样例。
+"""
+import re
+import sys
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+
+W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+A = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+P = '{http://schemas.openxmlformats.org/presentationml/2006/main}'
+R = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+MC = '{http://schemas.openxmlformats.org/markup-compatibility/2006}'
+PR = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+NOTES_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/notesSlide'
+HEADING_STYLE = re.compile(r'^(?:heading|标题)\s*(\d+)$', re.IGNORECASE)
+TITLE_TYPES = ('title', 'ctrTitle')
+
+
+def heading_level(style_name):
+    # 根据段落样式名判断标题级别，0 为正文
+    name = (style_name or '').strip()
+    if name.lower() == 'title':
+        return 1
+    m = HEADING_STYLE.match(name)
+    return int(m.group(1)) if m else 0
+
+
+def _rels(zf, part):
+    # 读取某个部件的关系表，返回 {rId: (type, 目标部件路径)}
+    folder, name = posixpath.split(part)
+    rels_path = posixpath.join(folder, '_rels', name + '.rels')
+    if rels_path not in zf.namelist():
+        return {}
+    rels = {}
+    for rel in ET.fromstring(zf.read(rels_path)).iter(PR + 'Relationship'):
+        target = rel.get('Target')
+        if rel.get('TargetMode') == 'External':
+            continue
+        if target.startswith('/'):
+            target = target[1:]
+        else:
+            target = posixpath.normpath(posixpath.join(folder, target))
+        rels[rel.get('Id')] = (rel.get('Type'), target)
+    return rels
+
+
+def _docx_styles(zf):
+    # styleId -> 样式名
+    if 'word/styles.xml' not in zf.namelist():
+        return {}
+    styles = {}
+    for style in ET.fromstring(zf.read('word/styles.xml')).iter(W + 'style'):
+        name = style.find(W + 'name')
+        styles[style.get(W + 'styleId')] = name.get(W + 'val') if name is not None else ''
+    return styles
+
+
+def _run_text(elem):
+    # w:r 内的文本元素对应的文字，与 python-docx 的 Run.text 相同：分页符、分栏符不算文字
+    tag = elem.tag
+    if tag == W + 't':
+        return elem.text or ''
+    if tag in (W + 'tab', W + 'ptab'):
+        return '\t'
+    if tag == W + 'br':
+        return '\n' if elem.get(W + 'type', 'textWrapping') == 'textWrapping' else ''
+    if tag == W + 'cr':
+        return '\n'
+    if tag == W + 'noBreakHyphen':
+        return '-'
+    return ''
+
+
+def iter_paragraphs(elem):
+    """按先序产出 elem（python-docx 的 oxml 元素）下的所有 w:p，跳过 mc:Fallback
+
+    Word 2010 起文本框保存为 mc:AlternateContent，mc:Choice（wps:txbx）和 mc:Fallback（v:textbox）
+    各有一份相同的内容，只读 mc:Choice，否则文本框中的段落会出现两次。
+    """
+    for child in elem:
+        if child.tag == MC + 'Fallback':
+            continue
+        if child.tag == W + 'p':
+            yield child
+        yield from iter_paragraphs(child)
+
+
+def paragraph_text(p, in_run=False):
+    """段落 p 中所有 w:r 的文字，包括修订插入（w:ins）、域（w:fldSimple）、内容控件（w:sdt）等包着的 w:r
+
+    不含内层段落（文本框）和 mc:Fallback；python-docx 的 Paragraph.text 只读直接位于 w:p 下的 w:r。
+    """
+    parts = []
+    for child in p:
+        if child.tag in (W + 'p', MC + 'Fallback'):
+            continue
+        if in_run:
+            parts.append(_run_text(child))
+        parts.append(paragraph_text(child, in_run or child.tag == W + 'r'))
+    return ''.join(parts)
+
+
+def iter_docx(path):
+    """按文档顺序产出 docx 中所有段落，包括表格和文本框中的段落
+
+    与 iter_paragraphs 一样按先序排列：文本框所在的段落在前，文本框中的段落紧随其后；
+    段落文字与 paragraph_text 相同。
+    """
+    with zipfile.ZipFile(path) as zf:
+        styles = _docx_styles(zf)
+        # 段落可能嵌套（文本框），用栈记录每层段落的文本、样式、已结束的内层段落，
+        # 以及所在 w:r 的层数（w:tab 也出现在段落格式的制表位定义中，只有位于 w:r 内的才是文本）
+        stack = []
+        # 位于 mc:Fallback 中的层数，其中的内容与 mc:Choice 重复
+        fallback = 0
+        i = 0
+        with zf.open('word/document.xml') as f:
+            for event, elem in ET.iterparse(f, events=('start', 'end')):
+                tag = elem.tag
+                if tag == MC + 'Fallback':
+                    fallback += 1 if event == 'start' else -1
+                    continue
+                if fallback:
+                    continue
+                if event == 'start':
+                    if tag == W + 'p':
+                        stack.append([[], 0, [], 0])
+                    elif tag == W + 'r' and stack:
+                        stack[-1][3] += 1
+                    continue
+                if not stack:
+                    continue
+                if tag == W + 'r':
+                    stack[-1][3] -= 1
+                elif tag == W + 'pStyle':
+                    stack[-1][1] = heading_level(styles.get(elem.get(W + 'val'), ''))
+                elif tag == W + 'p':
+                    parts, heading, nested, _ = stack.pop()
+                    paragraphs = [(heading, ''.join(parts))] + nested
+                    elem.clear()
+                    if stack:
+                        # 内层段落等外层段落结束后一起产出
+                        stack[-1][2].extend(paragraphs)
+                        continue
+                    for heading, text in paragraphs:
+                        yield None, i, heading, text
+                        i += 1
+                elif stack[-1][3]:
+                    stack[-1][0].append(_run_text(elem))
+
+
+def _iter_shapes_xml(f, body_only=False):
+    # 流式解析一张幻灯片（或备注页），产出 (heading, text)
+    # sp_stack 记录当前所在形状的占位符类型
+    sp_stack = []
+    parts = None
+    for event, elem in ET.iterparse(f, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            if tag == P + 'sp':
+                sp_stack.append(None)
+            elif tag == P + 'ph' and sp_stack:
+                sp_stack[-1] = elem.get('type', 'obj')
+            elif tag == A + 'p':
+                parts = []
+            continue
+        if tag == A + 't' and parts is not None:
+            parts.append(elem.text or '')
+        elif tag == A + 'br' and parts is not None:
+            parts.append('\v')
+        elif tag == A + 'p':
+            ph = sp_stack[-1] if sp_stack else None
+            # 页码占位符中是 PowerPoint 自动填写的页码，不是正文
+            if ph != 'sldNum' and (not body_only or ph == 'body'):
+                yield (1 if ph in TITLE_TYPES else 0), ''.join(parts)
+            parts = None
+            elem.clear()
+        elif tag == P + 'sp':
+            sp_stack.pop()
+            elem.clear()
+
+
+def iter_pptx(path):
+    """按幻灯片顺序产出 pptx 中的段落，包括组合形状、表格和演讲者备注"""
+    with zipfile.ZipFile(path) as zf:
+        pres_rels = _rels(zf, 'ppt/presentation.xml')
+        pres = ET.fromstring(zf.read('ppt/presentation.xml'))
+        slide_parts = [pres_rels[s.get(R + 'id')][1] for s in pres.iter(P + 'sldId')]
+        for s, part in enumerate(slide_parts):
+            i = 0
+            with zf.open(part) as f:
+                for heading, text in _iter_shapes_xml(f):
+                    yield s, i, heading, text
+                    i += 1
+            notes = [t for typ, t in _rels(zf, part).values() if typ == NOTES_REL]
+            if notes:
+                with zf.open(notes[0]) as f:
+                    for _, text in _iter_shapes_xml(f, body_only=True):
+                        yield s, i, 0, text
+                        i += 1
+
+
+def iter_blocks(path):
+    if path.lower().endswith('.pptx'):
+        return iter_pptx(path)
+    return iter_docx(path)
+
+
+_FIXTURE_NS = ' '.join(f'xmlns:{prefix}="{uri}"' for prefix, uri in (
+    ('w', W[1:-1]), ('a', A[1:-1]), ('mc', MC[1:-1]), ('v', 'urn:schemas-microsoft-com:vml'),
+    ('wp', 'http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing'),
+    ('wps', 'http://schemas.microsoft.com/office/word/2010/wordprocessingShape'),
+))
+
+
+def _write_fixtures(folder):
+    """生成一致性比对用的样例：含标题、表格、文本框（VML 和 Word 2010 起的 mc:AlternateContent）、
+    修订插入、域、内容控件、智能标记和分页符的 docx，含表格和备注的 pptx
+    """
+    from docx import Document
+    from docx.oxml import parse_xml
+    from pptx import Presentation
+    from pptx.util import Inches
+
+    doc = Document()
+    doc.add_heading('第一章', level=1)
+    outer = doc.add_paragraph('文本框前的文字')
+    # python-docx 不能直接创建文本框，插入一个 VML 文本框
+    outer._p.append(parse_xml(
+        f'<w:r {_FIXTURE_NS}><w:pict><v:shape><v:textbox><w:txbxContent>'
+        '<w:p><w:r><w:t>文本框第一段</w:t></w:r></w:p><w:p><w:r><w:t>文本框第二段</w:t></w:r></w:p>'
+        '</w:txbxContent></v:textbox></v:shape></w:pict></w:r>'))
+    outer.add_run('文本框后的文字')
+    # Word 2010 起保存的文本框：mc:Choice 和 mc:Fallback 中各有一份
+    box = doc.add_paragraph('新式文本框前')
+    box._p.append(parse_xml(
+        f'<w:r {_FIXTURE_NS}><mc:AlternateContent>'
+        '<mc:Choice Requires="wps"><w:drawing><wp:inline><a:graphic><a:graphicData '
+        'uri="http://schemas.microsoft.com/office/word/2010/wordprocessingShape"><wps:wsp><wps:txbx><w:txbxContent>'
+        '<w:p><w:r><w:t>文本框内容</w:t></w:r></w:p>'
+        '</w:txbxContent></wps:txbx></wps:wsp></a:graphicData></a:graphic></wp:inline></w:drawing></mc:Choice>'
+        '<mc:Fallback><w:pict><v:shape><v:textbox><w:txbxContent>'
+        '<w:p><w:r><w:t>文本框内容</w:t></w:r></w:p>'
+        '</w:txbxContent></v:textbox></v:shape></w:pict></mc:Fallback>'
+        '</mc:AlternateContent></w:r>'))
+    # 不直接位于 w:p 下的 w:r：修订插入、域、内容控件、智能标记；分页符不算文字
+    marked = doc.add_paragraph('前')
+    for tag, inner in (
+        ('w:ins w:id="1" w:author="a"', '<w:r><w:t>插入的文字</w:t></w:r>'),
+        ('w:fldSimple w:instr=" PAGE "', '<w:r><w:t>1</w:t></w:r>'),
+        ('w:sdt', '<w:sdtContent><w:r><w:t>控件</w:t></w:r></w:sdtContent>'),
+        ('w:smartTag w:uri="u" w:element="e"', '<w:r><w:t>标记</w:t></w:r>'),
+        ('w:del w:id="2" w:author="a"', '<w:r><w:delText>删除的文字</w:delText></w:r>'),
+        ('w:r', '<w:br w:type="page"/><w:t>分页后</w:t><w:br/><w:t>换行后</w:t>'),
+    ):
+        name = tag.split()[0]
+        marked._p.append(parse_xml(f'<{tag} {_FIXTURE_NS}>{inner}</{name}>'))
+    table = doc.add_table(rows=2, cols=2)
+    for r, row in enumerate(table.rows):
+        for c, cell in enumerate(row.cells):
+            cell.text = f'{1990 + r * 2 + c}'
+    doc.add_paragraph('结尾')
+    docx_path = posixpath.join(folder, 'fixture.docx')
+    doc.save(docx_path)
+    docx_texts = ['第一章', '文本框前的文字文本框后的文字', '文本框第一段', '文本框第二段', '新式文本框前', '文本框内容',
+                  '前插入的文字1控件标记分页后\n换行后', '1990', '1991', '1992', '1993', '结尾']
+
+    prs = Presentation()
+    slide = prs.slides.add_slide(prs.slide_layouts[1])
+    slide.shapes.title.text = '标题'
+    slide.placeholders[1].text = '正文'
+    shape = slide.shapes.add_table(2, 2, Inches(1), Inches(4), Inches(4), Inches(1))
+    for r, row in enumerate(shape.table.rows):
+        for c, cell in enumerate(row.cells):
+            cell.text = f'{r}-{c}'
+    slide.notes_slide.notes_text_frame.text = '备注'
+    pptx_path = posixpath.join(folder, 'fixture.pptx')
+    prs.save(pptx_path)
+    pptx_texts = ['标题', '正文', '0-0', '0-1', '1-0', '1-1', '备注']
+    # 返回 {样例路径: 应得到的各块文本}，两种解析结果一致但都有错（如文本框重复）时也能发现
+    return {docx_path: docx_texts, pptx_path: pptx_texts}
+
+
+if __name__ == '__main__':
+    # 与 python-docx / python-pptx 的解析结果比对；不给文件时比对内置的样例（含文本框、表格、备注）
+    import tempfile
+    from learning_assistant import DocumentLoader
+
+    loader = DocumentLoader()
+    ok = True
+    with tempfile.TemporaryDirectory() as folder:
+        expected = dict.fromkeys(sys.argv[1:]) or _write_fixtures(folder)
+        for path, texts in expected.items():
+            slow = [tuple(b) for b in loader.iter_blocks(path)]
+            fast = list(iter_blocks(path))
+            if texts is not None and [b[3] for b in fast] != texts:
+                ok = False
+                print(f'{path}: 与预期不符\n    {[b[3] for b in fast]}\n    {texts}')
+            if slow == fast:
+                print(f'{path}: 一致（{len(fast)} 个块）')
+                continue
+            ok = False
+            print(f'{path}: 不一致（python-docx/pptx {len(slow)} 个块，快速解析 {len(fast)} 个块）')
+            for a, b in zip(slow, fast):
+                if a != b:
+                    print(f'  首个差异:\n    {a}\n    {b}')
+                    break
+    sys.exit(0 if ok else 1)
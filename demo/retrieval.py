@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import re
+import zlib
+from collections import Counter
+from typing import NamedTuple
+
+import numpy as np
+
+_WORD = re.compile(r'[a-z0-9]+')
+_CJK_RUN = re.compile(r'[㐀-䶿一-鿿豈-﫿]+')
+
+
+def tokenize(text):
+    """检索用的切词：英文按单词，中文按相邻两字（二元组），不依赖分词库"""
+    text = text.lower()
+    terms = _WORD.findall(text)
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def term_id(term):
+    # 倒排表中的词以 crc32 表示；不同的词偶尔会得到相同的值，只会让个别片段的得分略有偏差
+    return zlib.crc32(term.encode('utf-8'))
+
+
+class Postings(NamedTuple):
+    """一篇文档的倒排表：按词排序的 (词, 片段序号, 词频) 三个数组，以及各片段的长度（词数）
+
+    保存文档时生成并随文档保存，之后构建检索索引只需读取它，不需要重新读取正文和切词。
+    """
+    terms: np.ndarray
+    chunks: np.ndarray
+    tf: np.ndarray
+    lengths: np.ndarray
+
+    @classmethod
+    def from_texts(cls, texts):
+        # texts 为文档切分后的各片段
+        terms, chunks, tf, lengths = [], [], [], []
+        for i, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            terms.extend(term_id(t) for t in counts)
+            chunks.extend([i] * len(counts))
+            tf.extend(counts.values())
+            lengths.append(sum(counts.values()))
+        terms = np.array(terms, dtype=np.uint32)
+        order = np.argsort(terms, kind='stable')
+        return cls(terms[order], np.array(chunks, dtype=np.uint32)[order],
+                   np.array(tf, dtype=np.uint32)[order], np.array(lengths, dtype=np.uint32))
+
+    def dump(self):
+        header = np.array([len(self.lengths), len(self.terms)], dtype=np.uint32)
+        return zlib.compress(b''.join(a.tobytes() for a in (header, self.lengths, self.terms, self.chunks, self.tf)))
+
+    @classmethod
+    def load(cls, data):
+        data = np.frombuffer(zlib.decompress(data), dtype=np.uint32)
+        n, m = int(data[0]), int(data[1])
+        lengths, rest = data[2:2 + n], data[2 + n:]
+        return cls(rest[:m], rest[m:2 * m], rest[2 * m:3 * m], lengths)
+
+
+class BM25Index:
+    """BM25 索引，由各文档的 Postings 组成；增删文档只增删它的倒排表，检索时逐篇文档查找查询词"""
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs = {}                      # 文档 -> Postings
+        self.chunks = 0
+        self.total_length = 0
+
+    def __len__(self):
+        return self.chunks
+
+    def add(self, doc, postings):
+        if doc in self.docs:
+            self.remove(doc)
+        self.docs[doc] = postings
+        self.chunks += len(postings.lengths)
+        self.total_length += int(postings.lengths.sum())
+
+    def remove(self, doc):
+        postings = self.docs.pop(doc, None)
+        if postings is None:
+            return
+        self.chunks -= len(postings.lengths)
+        self.total_length -= int(postings.lengths.sum())
+
+    def search(self, query, k=10, exclude=None):
+        """返回得分最高的 k 个 ((文档, 片段序号), score)；exclude(key) 为真的片段不参与排序"""
+        if not self.chunks:
+            return []
+        n = self.chunks
+        avg = self.total_length / n or 1
+        query = np.unique(np.array([term_id(t) for t in set(tokenize(query))], dtype=np.uint32))
+        # 第一遍统计每个查询词出现在多少个片段中，第二遍逐篇文档计算得分
+        df = np.zeros(len(query), dtype=np.int64)
+        for postings in self.docs.values():
+            df += np.searchsorted(postings.terms, query, 'right') - np.searchsorted(postings.terms, query, 'left')
+        idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+        ranked = []
+        for doc, postings in self.docs.items():
+            lo = np.searchsorted(postings.terms, query, 'left')
+            counts = np.searchsorted(postings.terms, query, 'right') - lo
+            total = int(counts.sum())
+            if not total:
+                continue
+            # 命中的各段 [lo, lo + count) 连接成一个下标数组
+            idx = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(total)
+            chunks = postings.chunks[idx]
+            tf = postings.tf[idx].astype(np.float64)
+            length = postings.lengths[chunks] / avg
+            norm = tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length))
+            size = len(postings.lengths)
+            scores = np.bincount(chunks, weights=np.repeat(idf, counts) * norm, minlength=size)
+            for i in np.flatnonzero(np.bincount(chunks, minlength=size)):
+                key = (doc, int(i))
+                if not (exclude and exclude(key)):
+                    ranked.append((key, float(scores[i])))
+        ranked.sort(key=lambda x: x[1], reverse=True)
+        return ranked[:k]
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import contextvars
+from contextlib import contextmanager
+
+# 当前线程（或协程）的流式输出接收者 callback(event, stage, text)，以及正在进行的请求所属的阶段
+_listener = contextvars.ContextVar('stream_listener', default=None)
+_stage = contextvars.ContextVar('stream_stage', default='default')
+
+
+@contextmanager
+def listen(callback):
+    """在 with 块内发出的模型请求把流式输出转给 callback(event, stage, text)
+
+    event 为 'start'（向模型发出一次请求，此前收到但未完成的文本作废，如重试或 RolePlaying 中
+    user_agent 的回复）、'delta'（新到的一段文本）或 'end'（governor.call 完成，最后一次请求的文本有效）。
+    只对当前线程生效，线程池中的请求（如并发提取知识领域）不会转发。
+    """
+    token = _listener.set(callback)
+    try:
+        yield
+    finally:
+        _listener.reset(token)
+
+
+@contextmanager
+def in_stage(stage):
+    token = _stage.set(stage)
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+
+
+class InOrder:
+    """并发进行的 n 个请求按序号顺序转发流式输出
+
+    排在最前面的未完成请求实时转发，其余的先缓存，前面的都完成后再补发，界面上的文本仍按顺序出现。
+    第 k 个请求在 listen(order.listener(k)) 中发出，结束（成功或失败）后调用 order.finish(k)。
+    创建时没有接收者则什么也不转发。
+    """
+
+    def __init__(self, n):
+        self.callback = _listener.get()
+        self.head = 0
+        self.buffers = [[] for _ in range(n)]
+        self.done = [False] * n
+
+    def listener(self, k):
+        if self.callback is None:
+            return None
+
+        def callback(event, stage, text):
+            if k == self.head:
+                self.callback(event, stage, text)
+            else:
+                self.buffers[k].append((event, stage, text))
+        return callback
+
+    def finish(self, k):
+        self.done[k] = True
+        while self.head < len(self.done) and self.done[self.head]:
+            self.head += 1
+            if self.head < len(self.done):
+                for event in self.buffers[self.head]:
+                    self.callback(*event)
+                self.buffers[self.head] = []
+
+
+def emit(event, text='', stage=None):
+    callback = _listener.get()
+    if callback is not None:
+        callback(event, stage or _stage.get(), text)
+
+
+def write(stage, text):
+    # 直接输出一段完整的文本，如章节标题
+    emit('delta', text, stage)
+    emit('end', '', stage)
+
+
+def _deltas(chunk):
+    for choice in chunk.choices:
+        if choice.delta.content:
+            yield choice.delta.content
+
+
+def forwarder():
+    """有接收者时返回把流式响应每一块的文本转发给接收者的函数 forward(chunk)，否则返回 None"""
+    callback, stage = _listener.get(), _stage.get()
+    if callback is None:
+        return None
+
+    def forward(chunk):
+        for text in _deltas(chunk):
+            callback('delta', stage, text)
+    return forward
+
+
+def forward(response):
+    # 非流式响应一次转发全部文本
+    for choice in getattr(response, 'choices', ()):
+        if choice.message.content:
+            emit('delta', choice.message.content)
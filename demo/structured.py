@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import re
+import json
+
+from domains import normalize_domain, split_domains
+
+_FENCE = re.compile(r'^```[a-zA-Z]*\s*|\s*```$')
+
+
+def extract_json(reply):
+    """从模型回复中取出 JSON 对象：去掉 markdown 代码块标记，容忍对象前后的说明文字"""
+    text = _FENCE.sub('', reply.strip())
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    start, end = text.find('{'), text.rfind('}')
+    if start < 0 or end <= start:
+        raise ValueError('回复中没有 JSON 对象')
+    return json.loads(text[start:end + 1])
+
+
+def parse_analysis(reply):
+    """校验 analyze 的回复，返回 (知识领域列表, 提纲)；格式不符时抛出 ValueError"""
+    data = extract_json(reply)
+    if not isinstance(data, dict):
+        raise ValueError('回复不是 JSON 对象')
+    domains = data.get('domains')
+    if isinstance(domains, str):
+        domains = split_domains(domains)
+    elif isinstance(domains, list) and all(isinstance(d, str) for d in domains):
+        domains = [d for d in (normalize_domain(d) for d in domains) if d]
+    else:
+        raise ValueError('domains 应为字符串列表')
+    outline = data.get('outline')
+    if isinstance(outline, list) and all(isinstance(line, str) for line in outline):
+        outline = '\n'.join(outline)
+    if not isinstance(outline, str) or not outline.strip():
+        raise ValueError('outline 应为非空字符串')
+    return domains, outline.strip()
@@ -1,13 +1,12 @@
-from camel.models import ModelFactory
 from camel.societies import RolePlaying
 from camel.messages import BaseMessage
-from camel.types import TaskType, ModelType, RoleType
-from camel.types import ModelPlatformType
-from camel.configs import SiliconFlowConfig
+from camel.types import TaskType, RoleType
 import re
 import json
-import time
-from config import API_KEY
+import asyncio
+import governor
+import streaming
+from config import API_KEY, BASE_URL
 
 
 
@@ -51,35 +50,51 @@ class DocumentGenerator:
         )
 
         # 创建生成Agent
-        self.generator = RolePlaying(
+        self.generator = self._new_generator()
+
+        # 存储文档结构
+        self.document_structure = {}
+        self.generated_sections = {}
+
+    def _new_generator(self):
+        # 异步生成时各部分并发，每个部分使用独立的生成Agent，避免对话记录互相穿插
+        return RolePlaying(
             assistant_role_name="会严格遵守字数要求的内容撰写专家",
             user_role_name="文档架构师",
             task_prompt="文档架构师会给出文档若干个独立的部分，内容撰写专家根据要求对各个部分生成相应的文档内容，他只会严格按照要求回答生成的对应内容（要求包括：生成的主题，方向，字数限制，关键点覆盖），不会多说话",
-            assistant_agent_kwargs={"model": generator_model},
-            user_agent_kwargs={"model": generator_model},
+            assistant_agent_kwargs={"model": self.generator_model},
+            user_agent_kwargs={"model": self.generator_model},
             with_task_specify=False,
             task_type=TaskType.AI_SOCIETY
         )
 
-        # 存储文档结构
-        self.document_structure = {}
-        self.generated_sections = {}
-
     def decompose_outline(self, outline: str):
         """将大纲文档分解为多个部分"""
         print("开始分解文档大纲...")
 
+        # 获取分解结果
+        assistant_response, user_response = governor.call(
+            self.decomposer.step, self._decomposition_task(outline), stage='decompose')
+        return self._parse_decomposition(assistant_response)
+
+    async def adecompose_outline(self, outline: str):
+        """decompose_outline 的异步版本"""
+        print("开始分解文档大纲...")
+        assistant_response, user_response = await governor.acall(
+            self.decomposer.astep, self._decomposition_task(outline), stage='decompose')
+        return self._parse_decomposition(assistant_response)
+
+    @staticmethod
+    def _decomposition_task(outline: str):
         # 创建分解任务消息
-        decomposition_task = BaseMessage(
+        return BaseMessage(
             role_name="任务协调员",
             content=f"请将以下文档大纲分解为独立的章节部分：\n\n{outline}",
             role_type=RoleType.USER,
             meta_dict={}
         )
 
-        # 获取分解结果
-        assistant_response, user_response = self.decomposer.step(decomposition_task)
-
+    def _parse_decomposition(self, assistant_response):
         if assistant_response.terminated:
             print(f"分解过程终止: {assistant_response.info['termination_reasons']}")
             return {}
@@ -123,8 +138,34 @@ class DocumentGenerator:
         """为指定部分生成内容"""
         if section_id in self.generated_sections:
             print(f"部分 {section_id} 已生成，跳过")
-            return self.generated_sections[section_id]
+            section = self.generated_sections[section_id]
+            streaming.write('section', f"## {section['title']}\n\n{section['content']}")
+            return section['content']
 
+        title, generation_task = self._section_task(section_id, section_spec)
+
+        # 获取生成结果；界面上先显示章节标题，再显示流式生成的内容
+        streaming.write('section', f"## {title}\n\n")
+        assistant_response, user_response = governor.call(self.generator.step, generation_task, stage='section')
+        return self._store_section(section_id, title, assistant_response)
+
+    async def agenerate_section(self, section_id: str, section_spec: dict | str):
+        """generate_section 的异步版本，使用独立的生成Agent，可与其他部分并发"""
+        if section_id in self.generated_sections:
+            print(f"部分 {section_id} 已生成，跳过")
+            section = self.generated_sections[section_id]
+            streaming.write('section', f"## {section['title']}\n\n{section['content']}")
+            return section['content']
+
+        title, generation_task = self._section_task(section_id, section_spec)
+        streaming.write('section', f"## {title}\n\n")
+        assistant_response, user_response = await governor.acall(
+            self._new_generator().astep, generation_task, stage='section')
+        return self._store_section(section_id, title, assistant_response)
+
+    @staticmethod
+    def _section_task(section_id: str, section_spec: dict | str):
+        """返回 (标题, 生成任务消息)"""
         # 如果section_spec是字符串，则将其视为内容，并创建一个临时字典
         if isinstance(section_spec, str):
             print(f"生成部分: {section_id} - 无标题 (内容为字符串)")
@@ -159,10 +200,9 @@ class DocumentGenerator:
             role_type=RoleType.USER,
             meta_dict={}
         )
+        return title, generation_task
 
-        # 获取生成结果
-        assistant_response, user_response = self.generator.step(generation_task)
-
+    def _store_section(self, section_id: str, title: str, assistant_response):
         if assistant_response.terminated:
             print(f"内容生成终止: {assistant_response.info['termination_reasons']}")
             generated_content = f"内容生成失败: {assistant_response.info['termination_reasons']}"
@@ -183,32 +223,57 @@ class DocumentGenerator:
 
     def generate_full_document(self, outline: str):
         """生成完整文档"""
-        # 步骤1: 分解大纲
-        sections = self.decompose_outline(outline)
-        time.sleep(30)
+        # 步骤1: 分解大纲（上次中途失败时沿用已有的分解，已生成的部分也会跳过）
+        sections = self.document_structure or self.decompose_outline(outline)
 
         # 步骤2: 按顺序生成各部分内容
         full_document = []
         for section_id, section_spec in sections.items():
             content = self.generate_section(section_id, section_spec)
-            if isinstance(section_spec,str):
-                full_document.append({
-                    "section_id": section_id,
-                    "title": "None",
-                    "content": content
-                })
-            else:
-                full_document.append({
-                    "section_id": section_id,
-                    "title": section_spec["title"],
-                    "content": content
-                })
-            # 添加延迟避免API速率限制
-            time.sleep(60)
+            full_document.append(self._document_entry(section_id, section_spec, content))
 
         # 步骤3: 组合完整文档
         return self._assemble_document(full_document)
 
+    async def agenerate_full_document(self, outline: str):
+        """generate_full_document 的异步版本：各部分在同一个事件循环中并发生成
+
+        排在最前面的未完成部分实时转发流式输出，其余部分先缓存，前面的部分都完成后再补发（见 streaming.InOrder）。
+        某个部分失败时仍等其余部分完成，已生成的部分保留在 generated_sections 中，再次生成时跳过。
+        """
+        sections = self.document_structure or await self.adecompose_outline(outline)
+
+        order = streaming.InOrder(len(sections))
+        tasks = []
+        for k, (section_id, section_spec) in enumerate(sections.items()):
+            # 任务创建时复制当前的上下文，各部分的流式输出经各自的接收者转发
+            with streaming.listen(order.listener(k)):
+                task = asyncio.ensure_future(self.agenerate_section(section_id, section_spec))
+            task.add_done_callback(lambda _, k=k: order.finish(k))
+            tasks.append(task)
+        full_document = []
+        try:
+            for (section_id, section_spec), task in zip(sections.items(), tasks):
+                content = await task
+                full_document.append(self._document_entry(section_id, section_spec, content))
+        finally:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return self._assemble_document(full_document)
+
+    @staticmethod
+    def _document_entry(section_id: str, section_spec: dict | str, content: str):
+        if isinstance(section_spec,str):
+            return {
+                "section_id": section_id,
+                "title": "None",
+                "content": content
+            }
+        return {
+            "section_id": section_id,
+            "title": section_spec["title"],
+            "content": content
+        }
+
     def _assemble_document(self, sections: list):
         """将各部分组合成完整文档"""
         document = "# 文档生成结果\n\n"
@@ -219,30 +284,42 @@ class DocumentGenerator:
 
 
 
-def create(outline):
-    # 初始化文档生成系统
-    model = ModelFactory.create(
-        model_platform=ModelPlatformType.SILICONFLOW,
-        model_type=ModelType.SILICONFLOW_DEEPSEEK_V3,  # 可选模型：DeepSeek-V3/R1 等
-        model_config_dict=SiliconFlowConfig(
-            temperature=0.3,  # 控制生成随机性 (0~1)
-            # max_tokens=8000,
-            stream=True
-        ).as_dict(),
-        api_key=API_KEY,  # 替换为你的 API 密钥
-        url='https://api.siliconflow.cn/v1'
-    )
-
-
-    generator = DocumentGenerator(
-        decomposer_model=model,  # 使用GPT-4分解大纲
-        generator_model=model  # 使用GPT-4生成内容
-    )
-
+# 中途失败的任务留下的生成器；再次为同一大纲生成文档时从失败处继续
+_unfinished = {}
 
-    # 生成完整文档
-    document = generator.generate_full_document(outline)
 
+def create(outline):
+    generator = _unfinished.pop(outline, None)
+    if generator is None:
+        generator = _new_generator()
+    try:
+        # 生成完整文档
+        document = generator.generate_full_document(outline)
+    except Exception:
+        _keep_unfinished(outline, generator)
+        raise
+    return _save(document)
+
+
+async def acreate(outline):
+    """create 的异步版本，各部分并发生成"""
+    generator = _unfinished.pop(outline, None)
+    if generator is None:
+        generator = _new_generator()
+    try:
+        document = await generator.agenerate_full_document(outline)
+    except Exception:
+        _keep_unfinished(outline, generator)
+        raise
+    return _save(document)
+
+
+def _keep_unfinished(outline, generator):
+    _unfinished.clear()
+    _unfinished[outline] = generator
+
+
+def _save(document):
     # 保存结果
     with open("generated_document.md", "w", encoding="utf-8") as f:
         f.write(document)
@@ -251,6 +328,17 @@ def create(outline):
 
     return document
 
+
+def _new_generator():
+    # 初始化文档生成系统
+    model = governor.make_model(API_KEY, BASE_URL)
+
+
+    return DocumentGenerator(
+        decomposer_model=model,  # 使用GPT-4分解大纲
+        generator_model=model  # 使用GPT-4生成内容
+    )
+
 # if __name__ == '__main__':
 #     outline = """
 #     ### 量子计算学习提纲  